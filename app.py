@@ -1,29 +1,288 @@
 import os
 import base64
+import copy
 import json
 import tempfile
 import subprocess
 import uuid
 import datetime as dt
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify, stream_with_context
 import boto3
 from botocore.config import Config
 import math
 import random
-from threading import Thread
+import fcntl
+import hashlib
+import heapq
+import itertools
+import shutil
+import signal
+import socket
+import sqlite3
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from threading import Thread, Condition, Lock, BoundedSemaphore, Timer, local
 import logging
+import logging.handlers
+import queue
+import sys
+import atexit
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
 # 🔧 FIX 1: Railway Variables
 MAX_DURATION = int(os.getenv('MAX_DURATION', '3600'))
 MAX_CONCURRENT = int(os.getenv('MAX_CONCURRENT', '5'))
 MAX_CLIPS = int(os.getenv('MAX_CLIPS', '40'))
+# LOG_RATE: righe/secondo massime per singolo punto di log (0 = nessun limite)
 LOG_RATE = int(os.getenv('LOG_RATE', '100'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+MAX_QUEUE = int(os.getenv('MAX_QUEUE', '20'))
+# Worker gunicorn (WEB_CONCURRENCY, letto anche da gunicorn): scheduler e coda sono per
+# processo, quindi MAX_CONCURRENT e MAX_QUEUE (limiti totali) vengono divisi fra i worker
+WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+WORKER_CONCURRENT = max(1, MAX_CONCURRENT // WEB_CONCURRENCY)
+WORKER_QUEUE = max(1, MAX_QUEUE // WEB_CONCURRENCY) if MAX_QUEUE else 0
+# /generate-batch: il body JSON (con l'audio base64 di ogni riga) sta tutto in memoria,
+# quindi righe e byte per richiesta sono limitati; per batch grandi usare audio_url
+MAX_BATCH_ROWS = int(os.getenv('MAX_BATCH_ROWS', '20'))
+MAX_BATCH_BYTES = int(os.getenv('MAX_BATCH_BYTES', str(64 * 1024 ** 2)))
+DEFAULT_JOB_SECONDS = int(os.getenv('DEFAULT_JOB_SECONDS', '600'))
+JOB_STORE = os.getenv('JOB_STORE', 'sqlite')
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(tempfile.gettempdir(), 'video_jobs.sqlite3'))
+JOB_TTL = int(os.getenv('JOB_TTL', '3600'))
+JOB_SWEEP_INTERVAL = int(os.getenv('JOB_SWEEP_INTERVAL', '60'))
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '8'))
+FETCH_DEADLINE = int(os.getenv('FETCH_DEADLINE', '600'))
+PEXELS_CONCURRENCY = int(os.getenv('PEXELS_CONCURRENCY', '4'))
+PEXELS_RPS = float(os.getenv('PEXELS_RPS', '3'))
+PIXABAY_CONCURRENCY = int(os.getenv('PIXABAY_CONCURRENCY', '4'))
+PIXABAY_RPS = float(os.getenv('PIXABAY_RPS', '1.5'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '20'))
+UPLOAD_PART_SIZE = max(5 * 1024 ** 2, int(os.getenv('UPLOAD_PART_SIZE', str(16 * 1024 ** 2))))
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '4'))
+UPLOAD_STREAMING = os.getenv('UPLOAD_STREAMING', '0') == '1'
+R2_INDEX_PATH = os.getenv('R2_INDEX_PATH', os.path.join(tempfile.gettempdir(), 'r2_index.sqlite3'))
+RETENTION_KEEP = int(os.getenv('RETENTION_KEEP', '1'))
+RETENTION_MAX_AGE = int(os.getenv('RETENTION_MAX_AGE', '0'))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '600'))
+SHEETS_FLUSH_INTERVAL = float(os.getenv('SHEETS_FLUSH_INTERVAL', '2'))
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', '100'))
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '6'))
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', os.path.join(tempfile.gettempdir(), 'webhook_outbox.sqlite3'))
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', '4'))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '12'))
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', '5'))
+# righe outbox consegnate o abbandonate tenute per debug (secondi), poi le pulisce lo sweeper
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', str(7 * 86400)))
+EVENTS_HISTORY = int(os.getenv('EVENTS_HISTORY', '500'))
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))
+STATUS_MAX_WAIT = float(os.getenv('STATUS_MAX_WAIT', '60'))
+# client /events e /status?wait= contemporanei per worker: ognuno tiene un thread gthread
+# (--threads 32) per tutta l'attesa; oltre il limite 503 + Retry-After
+EVENTS_MAX_WAITERS = int(os.getenv('EVENTS_MAX_WAITERS', '16'))
+SEARCH_CACHE_PATH = os.getenv('SEARCH_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'search_cache.sqlite3'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '86400'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '2000'))
+CLIP_CACHE_DIR = os.getenv('CLIP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'clip_cache'))
+CLIP_CACHE_MAX_BYTES = int(os.getenv('CLIP_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+AUDIO_SPOOL_DIR = os.getenv('AUDIO_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'audio_spool'))
+# Workspace per job (file intermedi + manifest dei checkpoint): può stare su tmpfs,
+# a patto di accettare che un riavvio del container perda i checkpoint.
+WORKSPACE_DIR = os.getenv('WORKSPACE_DIR', os.path.join(tempfile.gettempdir(), 'video_workspaces'))
+# byte prenotati per job in esecuzione (0 = nessuna ammissione per disco); un budget
+# che non entra nel disco dei workspace fa fallire subito i job invece di fermare la coda
+JOB_DISK_BUDGET = int(os.getenv('JOB_DISK_BUDGET', str(2 * 1024 ** 3)))
+WORKSPACE_MAX_BYTES = int(os.getenv('WORKSPACE_MAX_BYTES', '0'))
+WORKSPACE_KEEP_FAILED = os.getenv('WORKSPACE_KEEP_FAILED', '1') == '1'
+RESUME_ON_START = os.getenv('RESUME_ON_START', '1') == '1'
+SEGMENT_FETCH = os.getenv('SEGMENT_FETCH', '1') == '1'
+# Budget CPU per ffmpeg in questo processo: di default i core divisi fra i worker
+# gunicorn (WEB_CONCURRENCY), così i processi insieme non vanno in oversubscription.
+FFMPEG_CPU_BUDGET = int(os.getenv('FFMPEG_CPU_BUDGET', str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+NORMALIZE_PARALLEL = int(os.getenv('NORMALIZE_PARALLEL', str(max(1, FFMPEG_CPU_BUDGET // 2))))
+FFMPEG_THREADS = max(1, FFMPEG_CPU_BUDGET // max(1, NORMALIZE_PARALLEL))
+
+# Profili di render: unica tabella da cui escono tutti i parametri ffmpeg del job.
+# `draft` serve a controllare scelta clip e sync audio a ~1/5 del costo CPU
+# (720p, preset ultrafast, metà delle scene); `final` è la qualità di pubblicazione.
+RENDER_PROFILES = {
+    "final": {"width": 1920, "height": 1080, "fps": 30, "preset": "fast", "crf": 23,
+              "clip_share": 1.0, "audio_bitrate": "192k"},
+    "draft": {"width": 1280, "height": 720, "fps": 30, "preset": "ultrafast", "crf": 28,
+              "clip_share": 0.5, "audio_bitrate": "128k"},
+}
+DEFAULT_PROFILE = os.getenv('RENDER_PROFILE', 'final')
+
+def profile_args(profile):
+    """Parametri di normalizzazione clip del profilo: fanno parte della chiave della clip cache.
+
+    Tutte le clip di un job escono identiche (codec, risoluzione, fps, pix_fmt, timescale)
+    così concat e mux finale lavorano in stream copy senza ricodificare.
+    """
+    p = RENDER_PROFILES[profile]
+    w, h = p["width"], p["height"]
+    return [
+        "-vf", f"scale={w}:{h}:force_original_aspect_ratio=increase,crop={w}:{h},fps={p['fps']},format=yuv420p",
+        "-c:v", "libx264", "-preset", p["preset"], "-crf", str(p["crf"]), "-an",
+        "-video_track_timescale", "15360",
+    ]
+
+NORMALIZE_ARGS = profile_args("final")
+
+def normalize_args(duration, profile="final"):
+    """Argomenti ffmpeg di output per normalizzare una clip tagliata a `duration` secondi."""
+    return ["-t", f"{duration:.2f}", *profile_args(profile)]
+
+def job_profile(data):
+    """Profilo di render richiesto dal job (`profile` nel payload), con fallback al default."""
+    profile = str(data.get("profile") or DEFAULT_PROFILE).lower()
+    if profile not in RENDER_PROFILES:
+        raise ValueError(f"profilo di render sconosciuto: {profile} (validi: {', '.join(RENDER_PROFILES)})")
+    return profile
+
+# -------------------------------------------------
+# Logging strutturato: JSON per riga, coda non bloccante, rate limit per punto di log
+# -------------------------------------------------
+class JobContextFilter(logging.Filter):
+    """Aggiunge job_id e stage del job corrente (eseguito nel thread che logga)."""
+
+    def filter(self, record):
+        timer = getattr(_job_context, "timer", None)
+        record.job_id = getattr(timer, "job_id", None)
+        record.stage = getattr(timer, "_current", None)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per punto di log (file:riga): al massimo `rate` righe/secondo.
+
+    Gli errori passano sempre; la prima riga dopo uno scarto riporta quante ne
+    sono state soppresse.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._buckets = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, suppressed = self._buckets.get(site, (float(self.rate), now, 0))
+            tokens = min(float(self.rate), tokens + (now - updated) * self.rate)
+            if tokens < 1.0:
+                self._buckets[site] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[site] = (tokens - 1.0, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+            "site": f"{record.module}:{record.lineno}",
+            "thread": record.threadName,
+        }
+        for field in ("job_id", "stage", "suppressed"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Mette i record in coda senza mai bloccare: a coda piena il record viene scartato.
+
+    Il listener che scrive su stdout viene (ri)avviato nel processo corrente,
+    così sopravvive al fork dei worker gunicorn.
+    """
+
+    def __init__(self, log_queue, *handlers):
+        super().__init__(log_queue)
+        self._handlers = handlers
+        self._listener = None
+        self._pid = None
+        self._lock = Lock()
+        self.dropped = 0
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._listener = logging.handlers.QueueListener(self.queue, *self._handlers, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    _traceback = logging.Formatter()
+
+    def prepare(self, record):
+        # come QueueHandler.prepare il messaggio viene risolto qui (args fuori dalla coda),
+        # ma il traceback resta separato in exc_text invece di finire dentro msg
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self._traceback.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        with self._lock:
+            if self._listener and self._pid == os.getpid():
+                self._listener.stop()
+                self._listener, self._pid = None, None
+
+
+def setup_logging():
+    """Root logger → coda → stdout; JSON (LOG_FORMAT=json) o testo con emoji per lo sviluppo."""
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(job_id)s %(stage)s] %(message)s'))
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE)), stream)
+    handler.addFilter(RateLimitFilter(LOG_RATE))
+    handler.addFilter(JobContextFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    atexit.register(handler.stop)
+    return handler
+
+LOG_HANDLER = setup_logging()
 
 app = Flask(__name__)
 
@@ -38,6 +297,8 @@ R2_ACCOUNT_ID = os.environ.get("R2_ACCOUNT_ID")
 # Pexels / Pixabay API
 PEXELS_API_KEY = os.environ.get("PEXELS_API_KEY")
 PIXABAY_API_KEY = os.environ.get("PIXABAY_API_KEY")
+PEXELS_SEARCH_URL = os.environ.get("PEXELS_SEARCH_URL", "https://api.pexels.com/videos/search")
+PIXABAY_SEARCH_URL = os.environ.get("PIXABAY_SEARCH_URL", "https://pixabay.com/api/videos/")
 GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON", "")
 
 # ✅ ID FISSO AI TOOL MASTER ITALIA
@@ -46,11 +307,1063 @@ SPREADSHEET_ID = "1hNABNms2MdhcjY4XJK86U4e142MaCZMDIrSx5JVftqo"
 # 🔔 Webhook flusso 2 (AI Tool Master Italia)
 N8N_WEBHOOK_URL_FLUSSO2 = os.environ.get("N8N_WEBHOOK_URL_AI_TOOL_MASTER_FLUSSO2")
 
-jobs = {}
 MAX_JOBS = 50
+FINAL_STATUSES = ("completed", "failed")
+ACTIVE_STATUSES = ("queued", "processing")
 
-def get_gspread_client():
-    """Client Google Sheets per update Video_URL"""
+# -------------------------------------------------
+# Job store: stato dei job condiviso fra i worker gunicorn
+# -------------------------------------------------
+def finished_at(status, current):
+    """Istante di fine del job: fissato quando lo stato diventa finale, azzerato se riparte."""
+    if status not in FINAL_STATUSES:
+        return None
+    return current or time.time()
+
+
+class MemoryJobStore:
+    """Store in-process (un solo worker): utile in sviluppo."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = Lock()
+
+    def create(self, job_id, record):
+        with self._lock:
+            self._jobs[job_id] = dict(record, _finished_ts=finished_at(record.get("status"), None))
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return {k: v for k, v in job.items() if k != "_finished_ts"} if job else None
+
+    def update(self, job_id, fields):
+        """Merge dei campi nel record; ritorna il record aggiornato (o None)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            previous = job.get("status")
+            job.update(fields)
+            if job.get("status") != previous:
+                job["_finished_ts"] = finished_at(job.get("status"), None)
+            return {k: v for k, v in job.items() if k != "_finished_ts"}
+
+    def claim(self, job_id, expected_worker, worker):
+        """Passa il job a `worker` solo se è ancora di `expected_worker`."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.get("worker") != expected_worker:
+                return False
+            job["worker"] = worker
+            return True
+
+    def set_once(self, job_id, field, value):
+        """Scrive `field` solo se non è ancora valorizzato; False se c'era già."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.get(field):
+                return False
+            job[field] = value
+            return True
+
+    def active(self):
+        """Job in coda o in esecuzione (per il resume dopo un riavvio)."""
+        with self._lock:
+            return [
+                {k: v for k, v in job.items() if k != "_finished_ts"}
+                for job in self._jobs.values() if job.get("status") in ACTIVE_STATUSES
+            ]
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def evict(self, ttl, max_jobs):
+        """Rimuove i job finiti da più di `ttl` e quelli oltre `max_jobs`."""
+        cutoff = time.time() - ttl
+        with self._lock:
+            finished = sorted(
+                (job["_finished_ts"], job_id) for job_id, job in self._jobs.items()
+                if job.get("status") in FINAL_STATUSES
+            )
+            excess = max(0, len(self._jobs) - max_jobs)
+            removed = 0
+            for i, (finished_ts, job_id) in enumerate(finished):
+                if finished_ts < cutoff or i < excess:
+                    del self._jobs[job_id]
+                    removed += 1
+            return removed
+
+
+class SqliteBacked:
+    """Base per gli store SQLite condivisi fra thread e worker gunicorn (WAL)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _conn(self):
+        # una connessione per thread (e per processo: il pid cambia dopo il fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class SqliteJobStore(SqliteBacked):
+    """Store SQLite in WAL: lookup O(1) per job_id, indice su created_at per la TTL."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " created_at REAL NOT NULL,"
+            " status TEXT NOT NULL,"
+            " record TEXT NOT NULL,"
+            " finished_at REAL)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "finished_at" not in columns:
+            # store creato prima della colonna: i job già finiti scadono dalla migrazione
+            conn.execute("ALTER TABLE jobs ADD COLUMN finished_at REAL")
+            placeholders = ",".join("?" * len(FINAL_STATUSES))
+            conn.execute(f"UPDATE jobs SET finished_at = ? WHERE status IN ({placeholders})", (time.time(), *FINAL_STATUSES))
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+
+    def create(self, job_id, record):
+        status = record.get("status", "queued")
+        self._conn().execute(
+            "INSERT OR REPLACE INTO jobs (job_id, created_at, status, record, finished_at) VALUES (?, ?, ?, ?, ?)",
+            (job_id, time.time(), status, json.dumps(record), finished_at(status, None)),
+        )
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id, fields):
+        """Merge atomico dei campi nel record; ritorna il record aggiornato (o None)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT record, status, finished_at FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            job = json.loads(row[0])
+            job.update(fields)
+            status = job.get("status", "queued")
+            finished = row[2] if status == row[1] else finished_at(status, None)
+            conn.execute(
+                "UPDATE jobs SET status = ?, record = ?, finished_at = ? WHERE job_id = ?",
+                (status, json.dumps(job), finished, job_id),
+            )
+            conn.execute("COMMIT")
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, job_id, expected_worker, worker):
+        """Passa il job a `worker` solo se è ancora di `expected_worker` (compare-and-set)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            job = json.loads(row[0]) if row else None
+            if job is None or job.get("worker") != expected_worker:
+                conn.execute("COMMIT")
+                return False
+            job["worker"] = worker
+            conn.execute("UPDATE jobs SET record = ? WHERE job_id = ?", (json.dumps(job), job_id))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def set_once(self, job_id, field, value):
+        """Scrive `field` solo se non è ancora valorizzato (compare-and-set); False se c'era già."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            job = json.loads(row[0]) if row else None
+            if job is None or job.get(field):
+                conn.execute("COMMIT")
+                return False
+            job[field] = value
+            conn.execute("UPDATE jobs SET record = ? WHERE job_id = ?", (json.dumps(job), job_id))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def active(self):
+        """Job in coda o in esecuzione (per il resume dopo un riavvio)."""
+        placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+        rows = self._conn().execute(
+            f"SELECT record FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at",
+            ACTIVE_STATUSES,
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def delete(self, job_id):
+        self._conn().execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def evict(self, ttl, max_jobs):
+        """Rimuove i job finiti da più di `ttl` e quelli oltre `max_jobs`."""
+        conn = self._conn()
+        placeholders = ",".join("?" * len(FINAL_STATUSES))
+        removed = conn.execute(
+            f"DELETE FROM jobs WHERE finished_at < ? AND status IN ({placeholders})",
+            (time.time() - ttl, *FINAL_STATUSES),
+        ).rowcount
+        excess = len(self) - max_jobs
+        if excess > 0:
+            removed += conn.execute(
+                f"DELETE FROM jobs WHERE job_id IN ("
+                f" SELECT job_id FROM jobs WHERE status IN ({placeholders})"
+                f" ORDER BY finished_at LIMIT ?)",
+                (*FINAL_STATUSES, excess),
+            ).rowcount
+        return removed
+
+
+def make_job_store():
+    if JOB_STORE == "memory":
+        return MemoryJobStore()
+    return SqliteJobStore(JOB_DB_PATH)
+
+jobs = make_job_store()
+
+_sweeper_lock = Lock()
+_sweeper_pid = None
+
+def _sweep_jobs_forever():
+    while True:
+        time.sleep(JOB_SWEEP_INTERVAL)
+        try:
+            removed = jobs.evict(JOB_TTL, MAX_JOBS)
+            if removed:
+                logger.info(f"🧹 Job store: {removed} job scaduti rimossi")
+            discarded = JobCheckpoint.sweep(JOB_TTL)
+            if discarded:
+                logger.info(f"🧹 Checkpoint: {discarded} job abbandonati rimossi")
+            pruned = OUTBOX.prune(OUTBOX_RETENTION)
+            if pruned:
+                logger.info(f"🧹 Outbox: {pruned} webhook chiusi rimossi")
+            spooled = sweep_audio_spool(JOB_TTL)
+            if spooled:
+                logger.info(f"🧹 Audio spool: {spooled} file orfani rimossi")
+        except Exception as e:
+            logger.warning(f"⚠️ Errore sweeper job store: {e}")
+
+def start_job_sweeper():
+    """Un solo thread sweeper per processo (avviato lazy, dopo il fork)."""
+    global _sweeper_pid
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+        Thread(target=_sweep_jobs_forever, name="job-sweeper", daemon=True).start()
+
+# -------------------------------------------------
+# Checkpoint per stage: un job interrotto riparte dall'ultimo stage completato
+# -------------------------------------------------
+def disk_usage(root):
+    """Byte occupati dai file sotto `root` (0 se non esiste)."""
+    total = 0
+    for dirpath, _dirs, files in os.walk(root):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DiskBudgetError(RuntimeError):
+    """Il budget di un job non entra nemmeno con tutti i workspace vuoti: aspettare è inutile."""
+
+
+class DiskBudget:
+    """Ammissione dei job in base al disco: ogni job in esecuzione prenota JOB_DISK_BUDGET.
+
+    Un job parte solo se lo spazio libero sul filesystem dei workspace, meno le
+    prenotazioni non ancora usate, copre un altro budget e se il totale resta
+    sotto WORKSPACE_MAX_BYTES (se impostato). Le prenotazioni sono per processo.
+    Se il budget non può entrare in nessun caso `reserve` solleva DiskBudgetError
+    invece di lasciare la coda ferma.
+    """
+
+    def __init__(self, root, job_bytes, max_bytes):
+        self.root = root
+        self.job_bytes = job_bytes
+        self.max_bytes = max_bytes
+        self._reserved = set()
+        self._lock = Lock()
+        self._blocked = False
+
+    def _outstanding(self):
+        return sum(
+            max(0, self.job_bytes - disk_usage(os.path.join(self.root, job_id)))
+            for job_id in self._reserved
+        )
+
+    def reserve(self, job_id):
+        """True se il job ha (o aveva già) la prenotazione, False se deve aspettare."""
+        if not self.job_bytes:
+            return True
+        with self._lock:
+            if job_id in self._reserved:
+                return True
+            os.makedirs(self.root, exist_ok=True)
+            used = disk_usage(self.root)
+            disk_free = shutil.disk_usage(self.root).free
+            if self.job_bytes > disk_free + used or (self.max_bytes and self.job_bytes > self.max_bytes):
+                self._blocked = True
+                raise DiskBudgetError(
+                    f"JOB_DISK_BUDGET {self.job_bytes / 1024 ** 2:.0f}MB non entra nel disco dei workspace "
+                    f"(liberabili {(disk_free + used) / 1024 ** 2:.0f}MB, WORKSPACE_MAX_BYTES {self.max_bytes}): "
+                    f"ridurre JOB_DISK_BUDGET o liberare spazio"
+                )
+            outstanding = self._outstanding()
+            free = disk_free - outstanding
+            total = used + outstanding + self.job_bytes
+            ok = free >= self.job_bytes and (not self.max_bytes or total <= self.max_bytes)
+            if ok:
+                self._reserved.add(job_id)
+            elif not self._blocked:
+                logger.warning(f"💾 Budget disco esaurito (liberi {free / 1024 ** 2:.0f}MB): job {job_id} in attesa")
+            self._blocked = not ok
+            return ok
+
+    def release(self, job_id):
+        with self._lock:
+            self._reserved.discard(job_id)
+
+    def stats(self):
+        with self._lock:
+            reserved = len(self._reserved)
+        return {
+            "used_bytes": disk_usage(self.root),
+            "free_bytes": shutil.disk_usage(self.root).free if os.path.isdir(self.root) else None,
+            "job_budget_bytes": self.job_bytes,
+            "max_bytes": self.max_bytes,
+            "reserved_jobs": reserved,
+            "blocked": self._blocked,
+        }
+
+WORKSPACE_BUDGET = DiskBudget(WORKSPACE_DIR, JOB_DISK_BUDGET, WORKSPACE_MAX_BYTES)
+
+def current_worker():
+    """Identità del processo che esegue/accoda un job (host:pid)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def worker_alive(worker):
+    """False se il processo proprietario del job non esiste più.
+
+    Gli store sono su disco locale: un host diverso è un container precedente.
+    """
+    host, _, pid = (worker or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobCheckpoint:
+    """Workspace del job: directory con i file intermedi e un manifest JSON degli stage completati.
+
+    Il manifest viene riscritto in modo atomico dopo ogni stage; i file citati
+    vivono nella directory del job, così sopravvivono a riavvii e fallimenti.
+    Ogni intermedio va cancellato (`remove`) appena lo stage successivo l'ha consumato.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.root = os.path.join(WORKSPACE_DIR, job_id)
+        self._lock = Lock()
+        os.makedirs(self.root, exist_ok=True)
+        try:
+            with open(os.path.join(self.root, self.MANIFEST)) as f:
+                self.stages = json.load(f).get("stages", {})
+        except (FileNotFoundError, ValueError):
+            self.stages = {}
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def scratch(self, suffix=""):
+        """Path nuovo e univoco nel workspace per un file temporaneo."""
+        return self.path(f"tmp_{uuid.uuid4().hex}{suffix}")
+
+    def remove(self, *paths):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def usage(self):
+        return disk_usage(self.root)
+
+    def check_budget(self, expected=0):
+        """Prima di uno stage costoso: fallisce se workspace + `expected` byte in arrivo superano JOB_DISK_BUDGET."""
+        used = self.usage() + expected
+        if JOB_DISK_BUDGET and used > JOB_DISK_BUDGET:
+            raise RuntimeError(f"budget disco del job superato: {used / 1024 ** 2:.0f}MB > {JOB_DISK_BUDGET / 1024 ** 2:.0f}MB")
+
+    def adopt(self, src, name):
+        """Sposta `src` nella directory del job (no-op se c'è già)."""
+        dst = self.path(name)
+        if os.path.abspath(src) != dst:
+            shutil.move(src, dst)
+        return dst
+
+    def done(self, stage, *files):
+        """Dati dello stage se completato e se i file indicati esistono ancora."""
+        state = self.stages.get(stage)
+        if state is None:
+            return None
+        for key in files:
+            value = state.get(key)
+            for path in value if isinstance(value, list) else [value]:
+                if not path or not os.path.exists(path):
+                    return None
+        return state
+
+    def save(self, stage, **state):
+        with self._lock:
+            self.stages[stage] = state
+            tmp = self.path(f"{self.MANIFEST}.{uuid.uuid4().hex}.tmp")
+            with open(tmp, "w") as f:
+                json.dump({"job_id": self.job_id, "updated_at": time.time(), "stages": self.stages}, f)
+            os.replace(tmp, self.path(self.MANIFEST))
+            stages = list(self.stages)
+        jobs.update(self.job_id, {"checkpoint": stages})
+
+    def record_normalized(self, clip, path):
+        """Registra nello stage acquire la clip appena normalizzata, poi cancella la sorgente."""
+        source = clip["path"]
+        normalized = self.adopt(path, f"scene_{clip['scene']:03d}.norm.mp4")
+        with self._lock:
+            clip.update(path=normalized, normalized=True)
+            acquire = self.stages.get("acquire") or {"clips": []}
+            for entry in acquire["clips"]:
+                if entry["scene"] == clip["scene"]:
+                    entry.update(path=normalized, normalized=True)
+        self.save("acquire", **acquire)
+        self.remove(source)
+        return normalized
+
+    def discard(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def teardown(self):
+        """Dopo un fallimento: tiene manifest e output degli stage completati, il resto va via."""
+        keep = set()
+        pending = list(self.stages.values())
+        while pending:
+            value = pending.pop()
+            if isinstance(value, dict):
+                pending.extend(value.values())
+            elif isinstance(value, list):
+                pending.extend(value)
+            elif isinstance(value, str) and value.startswith(self.root + os.sep):
+                keep.add(os.path.basename(value))
+        self.retain(*keep)
+
+    def retain(self, *names):
+        """Tiene solo manifest e i file indicati; il resto della directory viene cancellato."""
+        keep = set(names) | {self.MANIFEST}
+        for name in os.listdir(self.root):
+            if name not in keep:
+                try:
+                    os.unlink(self.path(name))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def sweep(ttl):
+        """Rimuove i checkpoint di job spariti dallo store o finiti da più di `ttl`."""
+        removed = 0
+        cutoff = time.time() - ttl
+        try:
+            names = os.listdir(WORKSPACE_DIR)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            root = os.path.join(WORKSPACE_DIR, name)
+            job = jobs.get(name)
+            try:
+                stale = os.path.getmtime(root) < cutoff
+            except OSError:
+                continue
+            draft = job is not None and (job.get("data") or {}).get("profile") == "draft"
+            if job is None and stale or job is not None and job.get("status") == "completed" and (stale or not draft):
+                shutil.rmtree(root, ignore_errors=True)
+                removed += 1
+        return removed
+
+# -------------------------------------------------
+# Metriche Prometheus (per processo) + timing per stage di ogni job
+# -------------------------------------------------
+STAGE_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+
+
+class MetricsRegistry:
+    """Counter e histogram in memoria, esposti nel formato testo di Prometheus."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._meta = {}
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1.0):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        buckets = self._meta[name][2]
+        with self._lock:
+            key = self._key(name, labels)
+            hist = self._histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @staticmethod
+    def _fmt_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self, gauges=None):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: ([*v[0]], v[1], v[2]) for k, v in self._histograms.items()}
+        for name, (kind, help_text, buckets) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+            else:
+                for (n, labels), (counts, total, count) in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, c in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{self._fmt_labels(labels, [('le', bound)])} {c}")
+                    lines.append(f"{name}_bucket{self._fmt_labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._fmt_labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._fmt_labels(labels)} {count}")
+        for name, help_text, value in gauges or []:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+METRICS.describe("video_stage_seconds", "histogram", "Durata wall-clock di ogni stage della pipeline", STAGE_BUCKETS)
+METRICS.describe("video_provider_request_seconds", "histogram", "Latenza delle chiamate HTTP ai provider stock", HTTP_BUCKETS)
+METRICS.describe("video_provider_requests_total", "counter", "Chiamate HTTP ai provider stock per status")
+METRICS.describe("video_download_bytes_total", "counter", "Byte di clip scaricati")
+METRICS.describe("video_ffmpeg_cpu_seconds_total", "counter", "CPU (user+sys) dei processi ffmpeg per stage")
+METRICS.describe("video_ffmpeg_runs_total", "counter", "Processi ffmpeg eseguiti per stage ed esito")
+METRICS.describe("video_jobs_total", "counter", "Job terminati per esito")
+METRICS.describe("video_upload_part_seconds", "histogram", "Durata upload di ogni parte multipart su R2", HTTP_BUCKETS + (30, 60))
+METRICS.describe("video_upload_bytes_total", "counter", "Byte caricati su R2")
+METRICS.describe("video_r2_deleted_total", "counter", "Video rimossi da R2 dalla retention")
+METRICS.describe("video_sheets_flushes_total", "counter", "batch_update Google Sheets per esito")
+METRICS.describe("video_sheets_cells_total", "counter", "Celle scritte su Google Sheets")
+METRICS.describe("video_webhook_deliveries_total", "counter", "Tentativi di consegna webhook n8n per esito")
+
+
+class JobTimer:
+    """Breakdown per stage di un job (wall, CPU ffmpeg, contatori), salvato nel job store."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._lock = Lock()
+        self._stages = {}
+        self._current = None
+        self._started = None
+
+    def add(self, stage, wall=0.0, cpu=0.0, **counters):
+        with self._lock:
+            entry = self._stages.setdefault(stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0})
+            entry["wall_seconds"] += wall
+            entry["cpu_seconds"] += cpu
+            for name, value in counters.items():
+                entry[name] = entry.get(name, 0) + value
+
+    def begin(self, stage):
+        """Chiude lo stage corrente (se c'è) e ne apre uno nuovo."""
+        self.end()
+        self._current = stage
+        self._started = time.perf_counter()
+        EVENTS.publish(self.job_id, "stage", stage=stage)
+
+    def end(self):
+        if self._current is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        self.add(self._current, wall=elapsed)
+        METRICS.observe("video_stage_seconds", {"stage": self._current}, elapsed)
+        self._current = None
+        jobs.update(self.job_id, {"timings": self.snapshot()})
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                stage: {k: round(v, 3) if isinstance(v, float) else v for k, v in entry.items()}
+                for stage, entry in self._stages.items()
+            }
+
+
+class _NullTimer:
+    def add(self, stage, wall=0.0, cpu=0.0, **counters):
+        pass
+
+    def begin(self, stage):
+        pass
+
+    def end(self):
+        pass
+
+# -------------------------------------------------
+# Eventi di avanzamento: broadcaster in-process per SSE e long-poll di /status
+# -------------------------------------------------
+class ProgressBroadcaster:
+    """Ultimi eventi di ogni job in un ring buffer, con una Condition per job.
+
+    Chi aspetta dorme sulla Condition del proprio job e viene svegliato solo dagli
+    eventi di quel job, ma occupa un thread del worker: i client in attesa sono
+    limitati a `max_waiters` (acquire_waiter/release_waiter). Gli eventi vivono
+    nel processo che esegue il job; da un altro worker gunicorn si vede lo stato
+    nel job store (vedi /events).
+    """
+
+    FINISHED_KEEP = 600
+
+    def __init__(self, history, max_waiters):
+        self._lock = Lock()
+        self._seq = itertools.count(1)
+        self._channels = {}
+        self._history = history
+        self.max_waiters = max_waiters
+        self._waiters = 0
+        self._refused = 0
+
+    def acquire_waiter(self):
+        """Posto per un client in attesa; False se sono già `max_waiters`."""
+        with self._lock:
+            if self._waiters >= self.max_waiters:
+                self._refused += 1
+                return False
+            self._waiters += 1
+            return True
+
+    def release_waiter(self):
+        with self._lock:
+            self._waiters -= 1
+
+    def _channel(self, job_id):
+        channel = self._channels.get(job_id)
+        if channel is None:
+            channel = {"events": deque(maxlen=self._history), "cond": Condition(self._lock), "finished": None}
+            self._channels[job_id] = channel
+        channel["touched"] = time.monotonic()
+        return channel
+
+    def publish(self, job_id, event, **fields):
+        with self._lock:
+            channel = self._channel(job_id)
+            channel["events"].append(dict(fields, id=next(self._seq), event=event, ts=round(time.time(), 3)))
+            if event == "status" and fields.get("status") in FINAL_STATUSES:
+                channel["finished"] = time.monotonic()
+            channel["cond"].notify_all()
+            self._prune()
+
+    def _prune(self):
+        # canali di job finiti, o mai aggiornati qui (job eseguiti da un altro worker)
+        now = time.monotonic()
+        stale = [
+            job_id for job_id, c in self._channels.items()
+            if c["finished"] and c["finished"] < now - self.FINISHED_KEEP or c["touched"] < now - JOB_TTL
+        ]
+        for job_id in stale:
+            del self._channels[job_id]
+
+    def since(self, job_id, after=0):
+        with self._lock:
+            channel = self._channels.get(job_id)
+            return [e for e in channel["events"] if e["id"] > after] if channel else []
+
+    def wait(self, job_id, after=0, timeout=None):
+        """Eventi del job con id > `after`; se non ce ne sono aspetta fino a `timeout` secondi."""
+        with self._lock:
+            channel = self._channel(job_id)
+            channel["cond"].wait_for(
+                lambda: channel["events"] and channel["events"][-1]["id"] > after, timeout=timeout
+            )
+            return [e for e in channel["events"] if e["id"] > after]
+
+    def stats(self):
+        with self._lock:
+            return {"channels": len(self._channels), "waiters": self._waiters,
+                    "max_waiters": self.max_waiters, "refused_waiters": self._refused}
+
+EVENTS = ProgressBroadcaster(EVENTS_HISTORY, EVENTS_MAX_WAITERS)
+
+_job_context = local()
+
+def progress_publisher():
+    """Callback `publish(event, **fields)` legata al job corrente (no-op fuori da un job)."""
+    timer = getattr(_job_context, "timer", None)
+    job_id = getattr(timer, "job_id", None)
+    if job_id is None:
+        return lambda event, **fields: None
+    return lambda event, **fields: EVENTS.publish(job_id, event, **fields)
+
+def current_timer():
+    return getattr(_job_context, "timer", None) or _NullTimer()
+
+def scratch_path(suffix=""):
+    """File temporaneo nel workspace del job corrente (o nella tempdir fuori dai job)."""
+    workspace = getattr(_job_context, "workspace", None)
+    if workspace is not None:
+        return workspace.scratch(suffix)
+    return os.path.join(tempfile.gettempdir(), f"tmp_{uuid.uuid4().hex}{suffix}")
+
+def with_job_context(fn):
+    """Wrappa `fn` per eseguirla in un thread del pool con timer e workspace del job corrente."""
+    timer = getattr(_job_context, "timer", None)
+    workspace = getattr(_job_context, "workspace", None)
+    def run(*args, **kwargs):
+        _job_context.timer = timer
+        _job_context.workspace = workspace
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _job_context.timer = None
+            _job_context.workspace = None
+    return run
+
+def _read_ffmpeg_progress(fd, stage, duration, publish):
+    """Legge l'output di `-progress` e pubblica la percentuale di encode (a passi di 1%)."""
+    last = -1
+    with os.fdopen(fd, "r", errors="replace") as progress:
+        for line in progress:
+            key, _, value = line.strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                percent = min(100, int(int(value) / 1e6 / duration * 100))
+                if percent > last:
+                    last = percent
+                    publish("encode", stage=stage, percent=percent)
+
+def run_ffmpeg(cmd, stage, timeout=MAX_DURATION, check=True, stdout_consumer=None, progress_duration=None):
+    """Esegue ffmpeg registrando la CPU del processo (rusage) per lo stage.
+
+    Con `stdout_consumer` lo stdout di ffmpeg è una pipe passata alla callback
+    mentre il processo è ancora in esecuzione, insieme a `finished()`: aspetta
+    l'uscita di ffmpeg e dice se è terminato con successo. Con `progress_duration` (secondi
+    di output attesi) la percentuale di encode letta da `-progress` viene
+    pubblicata come evento del job.
+    """
+    progress_reader = None
+    pass_fds = ()
+    if progress_duration:
+        read_fd, write_fd = os.pipe()
+        cmd = [cmd[0], "-progress", f"pipe:{write_fd}", "-nostats", *cmd[1:]]
+        pass_fds = (write_fd,)
+        progress_reader = Thread(
+            target=_read_ffmpeg_progress, args=(read_fd, stage, progress_duration, progress_publisher()),
+            name="ffmpeg-progress", daemon=True,
+        )
+    with tempfile.TemporaryFile() as err:
+        try:
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE if stdout_consumer else subprocess.DEVNULL, stderr=err,
+                pass_fds=pass_fds,
+            )
+        finally:
+            if progress_reader:
+                os.close(write_fd)
+        if progress_reader:
+            progress_reader.start()
+        exited = {}
+        def finished():
+            if not exited:
+                _pid, exited["status"], exited["usage"] = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(exited["status"])
+            return proc.returncode == 0
+        def kill():
+            # niente Popen.kill: il suo poll() raccoglierebbe il processo prima di wait4
+            if not exited:
+                try:
+                    os.kill(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        killer = Timer(timeout, kill)
+        killer.start()
+        try:
+            if stdout_consumer:
+                try:
+                    stdout_consumer(proc.stdout, finished)
+                except Exception:
+                    kill()
+                    finished()
+                    raise
+                finally:
+                    proc.stdout.close()
+            finished()
+        finally:
+            timed_out = not killer.is_alive()
+            killer.cancel()
+        usage = exited["usage"]
+        if progress_reader:
+            progress_reader.join(timeout=5)
+        err.seek(0)
+        stderr = err.read().decode("utf-8", errors="replace")
+    cpu = usage.ru_utime + usage.ru_stime
+    ok = proc.returncode == 0
+    METRICS.inc("video_ffmpeg_cpu_seconds_total", {"stage": stage}, cpu)
+    METRICS.inc("video_ffmpeg_runs_total", {"stage": stage, "result": "ok" if ok else "error"})
+    current_timer().add(stage, cpu=cpu, ffmpeg_runs=1)
+    if timed_out and not ok:
+        raise subprocess.TimeoutExpired(cmd, timeout, stderr=stderr)
+    if check and not ok:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, None, stderr)
+
+# -------------------------------------------------
+# Scheduler: pool fisso di WORKER_CONCURRENT thread + coda con priorità (per processo)
+# -------------------------------------------------
+class QueueFullError(Exception):
+    """Coda piena: /generate risponde 429."""
+
+    def __init__(self, position, eta_seconds):
+        super().__init__(f"Coda piena ({position - 1} job in attesa)")
+        self.position = position
+        self.eta_seconds = eta_seconds
+
+
+class JobScheduler:
+    """Pool di worker a dimensione fissa che consuma una coda FIFO/priorità limitata."""
+
+    def __init__(self, target, workers, max_queue, budget=None, on_reject=None):
+        self.target = target
+        self.budget = budget
+        self.on_reject = on_reject
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._cond = Condition()
+        self._admission = Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._threads = []
+        self._waits = deque(maxlen=100)
+        self._durations = deque(maxlen=20)
+        self._completed = 0
+        self._rejected = 0
+
+    def _start_workers(self):
+        # avvio lazy: i thread non sopravvivono al fork dei worker gunicorn
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = Thread(target=self._worker_loop, name=f"render-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _ordered(self):
+        return [entry[3] for entry in sorted(self._heap)]
+
+    def _avg_duration(self):
+        if not self._durations:
+            return float(DEFAULT_JOB_SECONDS)
+        return sum(self._durations) / len(self._durations)
+
+    def _eta(self, position):
+        """Stima secondi prima che il job in `position` (1-based) inizi."""
+        ahead = position - 1 + self._running
+        return round(math.floor(ahead / self.workers) * self._avg_duration(), 1)
+
+    def submit(self, job_id, data, priority=0):
+        """Accoda il job; ritorna la posizione in coda o solleva QueueFullError."""
+        with self._cond:
+            if len(self._heap) >= self.max_queue:
+                self._rejected += 1
+                position = len(self._heap) + 1
+                raise QueueFullError(position, self._eta(position))
+            heapq.heappush(self._heap, (-priority, next(self._seq), time.monotonic(), job_id, data))
+            self._start_workers()
+            self._cond.notify()
+            return self._ordered().index(job_id) + 1
+
+    def capacity(self):
+        """Posti liberi in coda."""
+        with self._cond:
+            return max(0, self.max_queue - len(self._heap))
+
+    def position(self, job_id):
+        with self._cond:
+            ordered = self._ordered()
+            return ordered.index(job_id) + 1 if job_id in ordered else None
+
+    def eta(self, position):
+        with self._cond:
+            return self._eta(position)
+
+    def _reject(self, job_id, error):
+        with self._cond:
+            entry = next(e for e in self._heap if e[3] == job_id)
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+        logger.error(f"❌ Job {job_id} scartato: {error}")
+        if self.on_reject:
+            self.on_reject(job_id, error)
+
+    def _admit(self):
+        """Toglie dalla coda il prossimo job che ha il budget disco; ritorna (job_id, data).
+
+        La prenotazione scandisce il disco, quindi avviene fuori da `_cond` (submit e
+        position non aspettano); `_admission` fa ammettere un worker alla volta.
+        """
+        with self._admission:
+            while True:
+                with self._cond:
+                    while not self._heap:
+                        self._cond.wait()
+                    head = self._heap[0][3]
+                try:
+                    admitted = not self.budget or self.budget.reserve(head)
+                except DiskBudgetError as e:
+                    self._reject(head, str(e))
+                    continue
+                with self._cond:
+                    if not admitted:
+                        # budget disco esaurito: il job in testa aspetta (e riprova) invece di partire
+                        self._cond.wait(timeout=10)
+                        continue
+                    if self._heap[0][3] != head:
+                        # nel frattempo è arrivato un job più prioritario: la prenotazione resta
+                        # al vecchio job, che la ritrova quando torna in testa
+                        continue
+                    _prio, _seq, enqueued_at, job_id, data = heapq.heappop(self._heap)
+                    self._running += 1
+                    self._waits.append(time.monotonic() - enqueued_at)
+                    return job_id, data
+
+    def _worker_loop(self):
+        while True:
+            job_id, data = self._admit()
+            started = time.monotonic()
+            try:
+                self.target(job_id, data)
+            except Exception as e:
+                logger.error(f"❌ Worker errore job {job_id}: {e}")
+            finally:
+                if self.budget:
+                    self.budget.release(job_id)
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify()
+                    self._completed += 1
+                    self._durations.append(time.monotonic() - started)
+
+    def stats(self):
+        with self._cond:
+            waits = list(self._waits)
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": len(self._heap),
+                "max_queue": self.max_queue,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "avg_wait_seconds": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "max_wait_seconds": round(max(waits), 1) if waits else 0.0,
+                "avg_job_seconds": round(self._avg_duration(), 1),
+            }
+
+# -------------------------------------------------
+# Client condivisi (HTTP, R2, Google Sheets): uno per processo, riusati dai job
+# -------------------------------------------------
+class ClientPool:
+    """Client per processo, ricreati dopo il fork dei worker gunicorn."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pid = None
+        self._clients = {}
+
+    def get(self, name, factory):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._pid = os.getpid()
+            client = self._clients.get(name)
+            if client is None:
+                client = factory()
+                if client is not None:
+                    self._clients[name] = client
+            return client
+
+CLIENTS = ClientPool()
+
+def http_session(name, pool_size=10):
+    """requests.Session condivisa per `name` (keep-alive, pool di `pool_size` connessioni)."""
+    def factory():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, pool_size))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return CLIENTS.get(f"http:{name}", factory)
+
+def _build_gspread_client():
     try:
         if not GOOGLE_CREDENTIALS_JSON:
             return None
@@ -62,52 +1375,602 @@ def get_gspread_client():
         logger.error(f"Google Sheets client error: {e}")
         return None
 
-def get_s3_client():
-    """Client S3 configurato per Cloudflare R2"""
-    if R2_ACCOUNT_ID:
-        endpoint_url = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
-    else:
-        endpoint_url = None
-    if endpoint_url is None:
-        raise RuntimeError("Endpoint R2 non configurato: imposta R2_ACCOUNT_ID in Railway")
-    
+_gspread_refresh_lock = Lock()
+
+def get_gspread_client():
+    """Client Google Sheets per update Video_URL (condiviso, token rinnovato se scaduto)"""
+    gc = CLIENTS.get("gspread", _build_gspread_client)
+    credentials = getattr(getattr(gc, "http_client", None), "auth", None)
+    if credentials is not None and not getattr(credentials, "valid", True):
+        with _gspread_refresh_lock:
+            if not credentials.valid:
+                try:
+                    credentials.refresh(GoogleAuthRequest())
+                except Exception as e:
+                    logger.error(f"Google Sheets token refresh error: {e}")
+    return gc
+
+def _build_s3_client():
     session = boto3.session.Session()
-    s3_client = session.client(
+    return session.client(
         service_name="s3",
         region_name=R2_REGION,
-        endpoint_url=endpoint_url,
+        endpoint_url=f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com",
         aws_access_key_id=R2_ACCESS_KEY_ID,
         aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        config=Config(s3={"addressing_style": "virtual"}),
+        config=Config(
+            s3={"addressing_style": "virtual"},
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            retries={"max_attempts": 5, "mode": "adaptive"},
+        ),
     )
-    return s3_client
 
-def cleanup_old_videos(s3_client, current_key):
-    """Cancella tutti i video MP4 in R2 TRANNE quello appena caricato"""
-    try:
+def get_s3_client():
+    """Client S3 configurato per Cloudflare R2 (condiviso: i client boto3 sono thread-safe)"""
+    if not R2_ACCOUNT_ID:
+        raise RuntimeError("Endpoint R2 non configurato: imposta R2_ACCOUNT_ID in Railway")
+    return CLIENTS.get("s3", _build_s3_client)
+
+# -------------------------------------------------
+# Upload R2 multipart concorrente (da file o da pipe ffmpeg)
+# -------------------------------------------------
+class MultipartUpload:
+    """Upload multipart con parti in parallelo, retry per parte e timing."""
+
+    def __init__(self, s3_client, bucket, key, content_type="video/mp4"):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.upload_id = None
+        self._executor = ThreadPoolExecutor(max_workers=max(1, UPLOAD_CONCURRENCY), thread_name_prefix="r2-upload")
+        # limita i byte in memoria: al massimo 2 parti in coda per thread
+        self._inflight = BoundedSemaphore(max(1, UPLOAD_CONCURRENCY) * 2)
+        self._futures = []
+        self._lock = Lock()
+        self._part_seconds = []
+        self._retries = 0
+        self._bytes = 0
+        self._uploaded = 0
+        self._started = time.perf_counter()
+        self._publish = progress_publisher()
+
+    def add_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+            )["UploadId"]
+        self._inflight.acquire()
+        future = self._executor.submit(self._upload_part, len(self._futures) + 1, data)
+        future.add_done_callback(lambda _f: self._inflight.release())
+        self._futures.append(future)
+        self._bytes += len(data)
+
+    def _upload_part(self, number, data):
+        for attempt in range(HTTP_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                resp = self.s3.upload_part(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data
+                )
+            except Exception as e:
+                if attempt == HTTP_RETRIES:
+                    raise
+                with self._lock:
+                    self._retries += 1
+                backoff = min(30.0, 2 ** attempt) + random.random()
+                logger.warning(f"⏳ R2 parte {number} fallita ({e}), retry {attempt + 1}/{HTTP_RETRIES} fra {backoff:.1f}s")
+                time.sleep(backoff)
+                continue
+            elapsed = time.perf_counter() - started
+            METRICS.observe("video_upload_part_seconds", {}, elapsed)
+            with self._lock:
+                self._part_seconds.append(elapsed)
+                self._uploaded += len(data)
+                uploaded = self._uploaded
+            self._publish("upload", bytes=uploaded, parts=number)
+            return {"PartNumber": number, "ETag": resp["ETag"]}
+
+    def complete(self):
+        try:
+            parts = [f.result() for f in self._futures]
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=False)
+        return self.stats()
+
+    def abort(self):
+        for f in self._futures:
+            f.cancel()
+        if self.upload_id:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Abort multipart R2 fallito: {e}")
+
+    def stats(self):
+        seconds = time.perf_counter() - self._started
+        return {
+            "bytes": self._bytes,
+            "parts": len(self._futures),
+            "seconds": round(seconds, 2),
+            "mbps": round(self._bytes * 8 / 1e6 / seconds, 1) if seconds > 0 else 0.0,
+            "part_seconds_avg": round(sum(self._part_seconds) / len(self._part_seconds), 2) if self._part_seconds else 0.0,
+            "part_seconds_max": round(max(self._part_seconds), 2) if self._part_seconds else 0.0,
+            "retries": self._retries,
+        }
+
+def upload_stream(s3_client, bucket, key, stream, content_type="video/mp4", finalize=None):
+    """Carica su R2 leggendo `stream` a parti di UPLOAD_PART_SIZE; ritorna le statistiche.
+
+    `finalize()` viene chiamata a fine stream, prima di rendere visibile l'oggetto:
+    se ritorna False (es. ffmpeg uscito con errore) l'upload viene annullato, su R2
+    non resta niente e la funzione ritorna None.
+    """
+    started = time.perf_counter()
+    first = stream.read(UPLOAD_PART_SIZE)
+    if len(first) < UPLOAD_PART_SIZE:
+        # file piccolo: una sola PUT, solo se la sorgente è arrivata in fondo
+        if finalize and not finalize():
+            logger.warning(f"⚠️ Upload R2 {key} annullato: sorgente dello stream fallita")
+            return None
+        s3_client.put_object(Bucket=bucket, Key=key, Body=first, ContentType=content_type)
+        progress_publisher()("upload", bytes=len(first), parts=1)
+        seconds = time.perf_counter() - started
+        stats = {"bytes": len(first), "parts": 1, "seconds": round(seconds, 2),
+                 "mbps": round(len(first) * 8 / 1e6 / seconds, 1) if seconds > 0 else 0.0}
+    else:
+        upload = MultipartUpload(s3_client, bucket, key, content_type)
+        try:
+            chunk = first
+            while chunk:
+                upload.add_part(chunk)
+                chunk = stream.read(UPLOAD_PART_SIZE)
+            complete = finalize is None or finalize()
+        except Exception:
+            upload.abort()
+            raise
+        if not complete:
+            upload.abort()
+            logger.warning(f"⚠️ Upload R2 {key} annullato: sorgente dello stream fallita")
+            return None
+        stats = upload.complete()
+    METRICS.inc("video_upload_bytes_total", {}, stats["bytes"])
+    logger.info(f"☁️ Upload R2: {stats['bytes'] / 1024 ** 2:.1f}MB in {stats['parts']} parti, "
+                f"{stats['seconds']}s ({stats['mbps']} Mbit/s)")
+    return stats
+
+def upload_file_multipart(s3_client, bucket, key, path, content_type="video/mp4"):
+    with open(path, "rb") as f:
+        return upload_stream(s3_client, bucket, key, f, content_type)
+
+# -------------------------------------------------
+# Retention R2 in background: indice locale delle chiavi + delete_objects a batch
+# -------------------------------------------------
+class R2Index(SqliteBacked):
+    """Chiavi video caricate su R2, con il job che le ha prodotte."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS r2_objects ("
+            " key TEXT PRIMARY KEY,"
+            " job_id TEXT,"
+            " uploaded_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS r2_objects_uploaded_at ON r2_objects (uploaded_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS r2_meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def add(self, key, job_id=None, uploaded_at=None):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO r2_objects (key, job_id, uploaded_at) VALUES (?, ?, ?)",
+            (key, job_id, uploaded_at or time.time()),
+        )
+
+    def candidates(self, keep, max_age):
+        """Chiavi oltre le `keep` più recenti, o più vecchie di `max_age` secondi (0 = solo conteggio)."""
+        rows = self._conn().execute(
+            "SELECT key, job_id, uploaded_at FROM r2_objects ORDER BY uploaded_at DESC"
+        ).fetchall()
+        cutoff = time.time() - max_age if max_age > 0 else None
+        return [
+            (key, job_id, uploaded_at) for i, (key, job_id, uploaded_at) in enumerate(rows)
+            if i >= keep or (cutoff is not None and uploaded_at < cutoff)
+        ]
+
+    def add_existing(self, key, uploaded_at):
+        """Chiave trovata nel bucket: non sovrascrive quelle già indicizzate."""
+        self._conn().execute(
+            "INSERT OR IGNORE INTO r2_objects (key, job_id, uploaded_at) VALUES (?, NULL, ?)",
+            (key, uploaded_at),
+        )
+
+    def remove(self, keys):
+        self._conn().executemany("DELETE FROM r2_objects WHERE key = ?", [(k,) for k in keys])
+
+    def bootstrapped(self):
+        return self._conn().execute("SELECT 1 FROM r2_meta WHERE name = 'bootstrapped'").fetchone() is not None
+
+    def mark_bootstrapped(self):
+        self._conn().execute("INSERT OR REPLACE INTO r2_meta (name, value) VALUES ('bootstrapped', ?)", (str(time.time()),))
+
+
+class RetentionWorker:
+    """Un thread per processo che applica la policy di retention fuori dal percorso critico dei job."""
+
+    def __init__(self, index):
+        self.index = index
+        self._wake = Condition()
+        self._pending = False
+        self._pid = None
+        self._lock = Lock()
+
+    def trigger(self):
+        self._ensure_started()
+        with self._wake:
+            self._pending = True
+            self._wake.notify()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            Thread(target=self._loop, name="r2-retention", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            with self._wake:
+                if not self._pending:
+                    self._wake.wait(RETENTION_INTERVAL)
+                self._pending = False
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning(f"⚠️ Errore rotazione R2 (video vecchi restano): {str(e)}")
+
+    def _bootstrap(self, s3_client):
+        """Prima esecuzione: importa nell'indice i video già presenti nel bucket (un solo listing)."""
         paginator = s3_client.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix="videos/")
-        deleted_count = 0
-        for page in pages:
-            if "Contents" not in page:
+        imported = 0
+        for page in paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix="videos/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".mp4"):
+                    modified = obj.get("LastModified")
+                    self.index.add_existing(obj["Key"], modified.timestamp() if modified else 1.0)
+                    imported += 1
+        self.index.mark_bootstrapped()
+        logger.info(f"🗂️ Indice R2 inizializzato: {imported} video esistenti")
+
+    @staticmethod
+    def _protected(job_id, uploaded_at, notifying):
+        # n8n potrebbe non aver ancora usato l'URL: job ancora nel job store, video
+        # caricato (job finito) da meno di JOB_TTL, o webhook ancora in consegna
+        if job_id is None:
+            return False
+        return job_id in notifying or uploaded_at > time.time() - JOB_TTL or jobs.get(job_id) is not None
+
+    def run_once(self):
+        s3_client = get_s3_client()
+        if not self.index.bootstrapped():
+            self._bootstrap(s3_client)
+        notifying = OUTBOX.in_flight_jobs()
+        keys = [key for key, job_id, uploaded_at in self.index.candidates(RETENTION_KEEP, RETENTION_MAX_AGE)
+                if not self._protected(job_id, uploaded_at, notifying)]
+        deleted = 0
+        for i in range(0, len(keys), 1000):
+            batch = keys[i:i + 1000]
+            resp = s3_client.delete_objects(
+                Bucket=R2_BUCKET_NAME,
+                Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+            )
+            failed = {err["Key"] for err in resp.get("Errors", [])}
+            for err in resp.get("Errors", []):
+                logger.warning(f"⚠️ Cancellazione R2 fallita {err.get('Key')}: {err.get('Message')}")
+            done = [k for k in batch if k not in failed]
+            self.index.remove(done)
+            deleted += len(done)
+        if deleted:
+            METRICS.inc("video_r2_deleted_total", {}, deleted)
+            logger.info(f"✅ Rotazione completata: {deleted} video vecchi rimossi")
+        return deleted
+
+R2_INDEX = R2Index(R2_INDEX_PATH)
+RETENTION = RetentionWorker(R2_INDEX)
+
+# -------------------------------------------------
+# Write-back Google Sheets: coda unica, scritture coalescenti in batch_update
+# -------------------------------------------------
+class SheetsWriter:
+    """Raccoglie gli update di tutti i job e li scrive con un solo batch_update.
+
+    Il flush parte dopo SHEETS_FLUSH_INTERVAL secondi o a SHEETS_BATCH_SIZE celle;
+    errori di quota (429/5xx) vengono ritentati con backoff esponenziale.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._pending = {}  # (row, col) -> (value, job_id, attempts)
+        self._pid = None
+        self._worksheet = None
+        self._retry_at = 0.0
+        self._first_at = 0.0
+        self._inflight = 0
+        self._force = False
+
+    def enqueue(self, job_id, cells):
+        """`cells`: lista di (row, col, value). Un update successivo sulla stessa cella vince."""
+        self._ensure_started()
+        with self._cond:
+            if not self._pending:
+                self._first_at = time.monotonic()
+            for row, col, value in cells:
+                self._pending[(row, col)] = (value, job_id, 0)
+            self._cond.notify_all()
+        jobs.update(job_id, {"sheets": "pending"})
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._worksheet = None
+            Thread(target=self._loop, name="sheets-writer", daemon=True).start()
+
+    def drain(self, timeout=30.0):
+        """Forza il flush e attende che la coda sia vuota (shutdown / benchmark)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._force = True
+            self._cond.notify_all()
+            while (self._pending or self._inflight) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._force = False
+            return not (self._pending or self._inflight)
+
+    def _sheet(self):
+        if self._worksheet is None:
+            gc = get_gspread_client()
+            if gc is None:
+                raise RuntimeError("client Google Sheets non disponibile")
+            self._worksheet = gc.open_by_key(SPREADSHEET_ID).sheet1
+        return self._worksheet
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                # finestra di coalescenza dal primo update in coda (o fine del backoff)
+                due = max(self._retry_at, self._first_at + SHEETS_FLUSH_INTERVAL)
+                if self._force or len(self._pending) >= SHEETS_BATCH_SIZE:
+                    due = self._retry_at
+                if now >= due:
+                    break
+                self._cond.wait(due - now)
+            batch = dict(list(self._pending.items())[:SHEETS_BATCH_SIZE])
+            for cell in batch:
+                del self._pending[cell]
+            self._inflight = len(batch)
+            return batch
+
+    def _requeue(self, batch, error):
+        dropped = {}
+        with self._cond:
+            self._inflight = 0
+            if not self._pending:
+                self._first_at = time.monotonic()
+            for cell, (value, job_id, attempts) in batch.items():
+                if cell in self._pending:
+                    continue  # nel frattempo è arrivato un valore più recente
+                if attempts + 1 > SHEETS_MAX_RETRIES:
+                    dropped[job_id] = cell
+                else:
+                    self._pending[cell] = (value, job_id, attempts + 1)
+            max_attempts = max((a for _v, _j, a in self._pending.values()), default=0)
+            backoff = min(60.0, 2 ** max_attempts) + random.random()
+            self._retry_at = time.monotonic() + backoff
+        logger.warning(f"⏳ Sheets batch fallito ({error}), retry fra {backoff:.1f}s")
+        for job_id, (row, _col) in dropped.items():
+            logger.error(f"❌ Sheets fallito row {row}: {error}")
+            jobs.update(job_id, {"sheets": "failed"})
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            data = [
+                {"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]}
+                for (row, col), (value, _job_id, _attempts) in batch.items()
+            ]
+            try:
+                self._sheet().batch_update(data, raw=False)
+            except Exception as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status not in (429, 500, 502, 503):
+                    self._worksheet = None  # handle scaduto o client da ricreare
+                METRICS.inc("video_sheets_flushes_total", {"result": "error"})
+                self._requeue(batch, e)
                 continue
-            for obj in page["Contents"]:
-                key = obj["Key"]
-                if key.endswith(".mp4") and key != current_key:
-                    s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=key)
-                    deleted_count += 1
-                    print(f"🗑️ Cancellato vecchio video: {key}", flush=True)
-        if deleted_count > 0:
-            print(f"✅ Rotazione completata: {deleted_count} video vecchi rimossi", flush=True)
+            METRICS.inc("video_sheets_flushes_total", {"result": "ok"})
+            METRICS.inc("video_sheets_cells_total", {}, len(batch))
+            done_jobs = {job_id for _value, job_id, _attempts in batch.values()}
+            rows = sorted({row for row, _col in batch})
+            logger.info(f"📊 ✅ Sheets batch: {len(batch)} celle, righe {rows}")
+            for job_id in done_jobs:
+                jobs.update(job_id, {"sheets": "written"})
+            with self._cond:
+                self._inflight = 0
+                self._retry_at = 0.0
+                self._cond.notify_all()
+
+SHEETS = SheetsWriter()
+
+# -------------------------------------------------
+# Outbox webhook n8n: eventi persistiti su SQLite, consegnati in background
+# -------------------------------------------------
+class WebhookOutbox(SqliteBacked):
+    """Eventi webhook durevoli con retry, backoff esponenziale e idempotency key.
+
+    Le righe vengono "prese" con un lease atomico, così più worker gunicorn
+    possono consegnare dalla stessa outbox senza doppi invii concorrenti.
+    """
+
+    LEASE_SECONDS = 60
+
+    def __init__(self, path):
+        super().__init__(path)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " job_id TEXT NOT NULL,"
+            " idempotency_key TEXT NOT NULL UNIQUE,"
+            " url TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL,"
+            " delivered_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_job ON outbox (job_id)")
+        self._wake = Condition()
+        self._pid = None
+        self._start_lock = Lock()
+
+    @staticmethod
+    def idempotency_key(job_id, event):
+        return hashlib.sha256(f"{job_id}:{event}".encode("utf-8")).hexdigest()[:32]
+
+    def enqueue(self, job_id, event, url, payload):
+        key = self.idempotency_key(job_id, event)
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR IGNORE INTO outbox (job_id, idempotency_key, url, payload, status, next_attempt_at, created_at)"
+            " VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            (job_id, key, url, json.dumps(dict(payload, event_id=key)), now, now),
+        )
+        self.ensure_started()
+        with self._wake:
+            self._wake.notify()
+        return key
+
+    def status_for(self, job_id):
+        row = self._conn().execute(
+            "SELECT status, attempts, last_error, delivered_at FROM outbox WHERE job_id = ? ORDER BY id DESC LIMIT 1",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, attempts, last_error, delivered_at = row
+        return {"status": status, "attempts": attempts, "last_error": last_error, "delivered_at": delivered_at}
+
+    def prune(self, max_age):
+        """Cancella le righe consegnate o abbandonate da più di `max_age` secondi."""
+        cutoff = time.time() - max_age
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM outbox WHERE status = 'delivered' AND delivered_at < ?", (cutoff,)).rowcount
+        # per le abbandonate next_attempt_at è l'ultimo tentativo
+        removed += conn.execute("DELETE FROM outbox WHERE status = 'failed' AND next_attempt_at < ?", (cutoff,)).rowcount
+        return removed
+
+    def in_flight_jobs(self):
+        """Job con un webhook non ancora consegnato (né abbandonato)."""
+        rows = self._conn().execute("SELECT DISTINCT job_id FROM outbox WHERE status IN ('pending', 'sending')")
+        return {row[0] for row in rows}
+
+    def _claim(self, limit):
+        """Prende fino a `limit` eventi scaduti (pending o con lease scaduto)."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, idempotency_key, url, payload, attempts FROM outbox"
+                " WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?"
+                " ORDER BY next_attempt_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                [(now + self.LEASE_SECONDS, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _deliver(self, row):
+        event_id, key, url, payload, attempts = row
+        attempts += 1
+        try:
+            resp = http_session("webhook", WEBHOOK_CONCURRENCY).post(
+                url, data=payload, timeout=15,
+                headers={"Content-Type": "application/json", "Idempotency-Key": key},
+            )
+            ok = 200 <= resp.status_code < 300
+            error = None if ok else f"HTTP {resp.status_code}"
+        except Exception as e:
+            ok, error = False, str(e)[:300]
+        conn = self._conn()
+        if ok:
+            conn.execute(
+                "UPDATE outbox SET status = 'delivered', attempts = ?, last_error = NULL, delivered_at = ? WHERE id = ?",
+                (attempts, time.time(), event_id),
+            )
+            logger.info(f"🔔 Webhook n8n flusso2 consegnato (tentativo {attempts})")
+        elif attempts >= WEBHOOK_MAX_ATTEMPTS:
+            conn.execute(
+                "UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, error, event_id),
+            )
+            logger.error(f"❌ Webhook n8n flusso2 abbandonato dopo {attempts} tentativi: {error}")
         else:
-            print("✅ Nessun video vecchio da rimuovere", flush=True)
-    except Exception as e:
-        print(f"⚠️ Errore rotazione R2 (video vecchi restano): {str(e)}", flush=True)
+            backoff = min(3600.0, 5 * 2 ** (attempts - 1)) + random.random()
+            conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (attempts, error, time.time() + backoff, event_id),
+            )
+            logger.warning(f"⚠️ Webhook n8n flusso2 fallito ({error}), retry {attempts}/{WEBHOOK_MAX_ATTEMPTS} fra {backoff:.0f}s")
+        METRICS.inc("video_webhook_deliveries_total", {"result": "ok" if ok else "error"})
+
+    def ensure_started(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            Thread(target=self._dispatch_loop, name="webhook-outbox", daemon=True).start()
+
+    def _dispatch_loop(self):
+        executor = ThreadPoolExecutor(max_workers=max(1, WEBHOOK_CONCURRENCY), thread_name_prefix="webhook")
+        while True:
+            try:
+                rows = self._claim(WEBHOOK_CONCURRENCY)
+                if rows:
+                    futures_wait([executor.submit(self._deliver, row) for row in rows])
+                    continue
+            except Exception as e:
+                logger.warning(f"⚠️ Errore dispatcher outbox webhook: {e}")
+            with self._wake:
+                self._wake.wait(WEBHOOK_POLL_INTERVAL)
+
+OUTBOX = WebhookOutbox(OUTBOX_PATH)
 
 def notify_n8n_flusso2(job):
-    """Invia webhook a n8n quando il job è completato."""
+    """Mette in outbox il webhook n8n di job completato (consegna in background)."""
     if not N8N_WEBHOOK_URL_FLUSSO2:
-        print("⚠️ N8N_WEBHOOK_URL_AI_TOOL_MASTER_FLUSSO2 non configurata, skip webhook", flush=True)
+        logger.warning("⚠️ N8N_WEBHOOK_URL_AI_TOOL_MASTER_FLUSSO2 non configurata, skip webhook")
         return
 
     try:
@@ -124,10 +1987,10 @@ def notify_n8n_flusso2(job):
             "playlist": job.get("data", {}).get("playlist"),
             "channel": "ai_tool_master_italia",
         }
-        resp = requests.post(N8N_WEBHOOK_URL_FLUSSO2, json=payload, timeout=15)
-        print(f"🔔 Webhook n8n flusso2 status={resp.status_code}", flush=True)
+        OUTBOX.enqueue(job.get("job_id"), "video_completed", N8N_WEBHOOK_URL_FLUSSO2, payload)
+        logger.info("🔔 Webhook n8n flusso2 in outbox")
     except Exception as e:
-        print(f"⚠️ Errore invio webhook n8n flusso2: {e}", flush=True)
+        logger.warning(f"⚠️ Errore outbox webhook n8n flusso2: {e}")
 
 # -------------------------------------------------
 # Mapping SCENA → QUERY visiva (canale AI TOOL MASTER ITALIA)
@@ -182,93 +2045,753 @@ def is_ai_tool_video_metadata(video_data, source):
     else:
         text = " ".join(video_data.get("tags", [])).lower()
     
-    tech_count = sum(1 for kw in tech_keywords if kw in text)
     has_banned = any(kw in text for kw in banned)
     
-    if has_banned:
-        status = "❌ BANNED"
-    elif tech_count >= 1:
-        status = f"✅ TECH({tech_count})"
-    else:
-        status = f"⚠️ NEUTRAL(tech:{tech_count})"
-    
-    print(f"🔍 [{source}] '{text[:60]}...' → {status}", flush=True)
+    # trace del filtro: solo con LOG_LEVEL=DEBUG (25 candidati × 40 scene per job)
+    if logger.isEnabledFor(logging.DEBUG):
+        tech_count = sum(1 for kw in tech_keywords if kw in text)
+        if has_banned:
+            status = "❌ BANNED"
+        elif tech_count >= 1:
+            status = f"✅ TECH({tech_count})"
+        else:
+            status = f"⚠️ NEUTRAL(tech:{tech_count})"
+        logger.debug(f"🔍 [{source}] '{text[:60]}...' → {status}")
     return not has_banned
 
-def download_file(url: str) -> str:
-    tmp_clip = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-    clip_resp = requests.get(url, stream=True, timeout=30)
-    clip_resp.raise_for_status()
-    for chunk in clip_resp.iter_content(chunk_size=1024 * 1024):
-        if chunk:
-            tmp_clip.write(chunk)
-    tmp_clip.close()
-    return tmp_clip.name
+# -------------------------------------------------
+# Rate limiting per provider (Pexels / Pixabay)
+# -------------------------------------------------
+class ProviderLimiter:
+    """Concorrenza massima + richieste/secondo per provider, retry con backoff su 429/5xx."""
+
+    def __init__(self, name, concurrency, rps):
+        self.name = name
+        self.pool_size = max(1, concurrency)
+        self._sem = BoundedSemaphore(self.pool_size)
+        self._interval = 1.0 / rps if rps > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = Lock()
+
+    def _wait_slot(self, deadline):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            if deadline and slot > deadline:
+                raise TimeoutError(f"{self.name}: deadline acquisizione superata")
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def get(self, url, deadline=None, **kwargs):
+        for attempt in range(HTTP_RETRIES + 1):
+            with self._sem:
+                self._wait_slot(deadline)
+                started = time.perf_counter()
+                resp = http_session(self.name.lower(), self.pool_size).get(url, **kwargs)
+                elapsed = time.perf_counter() - started
+            provider = self.name.lower()
+            METRICS.observe("video_provider_request_seconds", {"provider": provider}, elapsed)
+            METRICS.inc("video_provider_requests_total", {"provider": provider, "status": resp.status_code})
+            current_timer().add("search", wall=elapsed, requests=1)
+            if resp.status_code != 429 and resp.status_code < 500:
+                return resp
+            if attempt == HTTP_RETRIES:
+                return resp
+            retry_after = resp.headers.get("Retry-After", "")
+            backoff = float(retry_after) if retry_after.isdigit() else min(30.0, 2 ** attempt) + random.random()
+            if deadline and time.monotonic() + backoff > deadline:
+                return resp
+            logger.warning(f"⏳ {self.name} HTTP {resp.status_code}, retry {attempt + 1}/{HTTP_RETRIES} fra {backoff:.1f}s")
+            time.sleep(backoff)
+        return resp
+
+PROVIDER_LIMITERS = {
+    "pexels": ProviderLimiter("Pexels", PEXELS_CONCURRENCY, PEXELS_RPS),
+    "pixabay": ProviderLimiter("Pixabay", PIXABAY_CONCURRENCY, PIXABAY_RPS),
+}
+
+# -------------------------------------------------
+# Cache su disco delle ricerche stock (provider + query normalizzata + pagina)
+# -------------------------------------------------
+class SearchCache(SqliteBacked):
+    """Risposte di ricerca Pexels/Pixabay con TTL, tetto di voci ed eviction LRU."""
+
+    def __init__(self, path, ttl, max_entries):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._stats_lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            " key TEXT PRIMARY KEY,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " payload TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS search_cache_last_used ON search_cache (last_used)")
+
+    @staticmethod
+    def make_key(provider, query, page):
+        normalized = " ".join((query or "").lower().split())
+        return f"{provider}|{page}|{normalized}"
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def get(self, provider, query, page=1):
+        """Lista di risultati in cache, o None se assente/scaduta."""
+        if self.ttl <= 0:
+            return None
+        key = self.make_key(provider, query, page)
+        conn = self._conn()
+        row = conn.execute("SELECT created_at, payload FROM search_cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[0] > self.ttl:
+            if row is not None:
+                conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+            self._count(False)
+            return None
+        conn.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+        self._count(True)
+        return json.loads(row[1])
+
+    def put(self, provider, query, page, items):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO search_cache (key, created_at, last_used, payload) VALUES (?, ?, ?, ?)",
+            (self.make_key(provider, query, page), now, now, json.dumps(items)),
+        )
+        excess = conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM search_cache WHERE key IN ("
+                " SELECT key FROM search_cache ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self._hits, self._misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "entries": self._conn().execute("SELECT COUNT(*) FROM search_cache").fetchone()[0],
+        }
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_PATH, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+
+# -------------------------------------------------
+# Clip cache content-addressed (sorgente + parametri di normalizzazione)
+# -------------------------------------------------
+class ClipCache:
+    """Clip già normalizzate su disco, con budget in byte ed eviction LRU (mtime).
+
+    Le voci vengono scritte con link/rename atomici e consegnate ai job come
+    hardlink: un'eviction concorrente non tocca mai i file di un job in corso.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._stats_lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, source_id, params=None):
+        signature = " ".join(params or NORMALIZE_ARGS)
+        return hashlib.sha256(f"{source_id}|{signature}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.mp4")
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    @staticmethod
+    def _link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
 
-def fetch_clip_for_scene(scene_number: int, query: str, avg_scene_duration: float):
-    """🎯 Canale AI TOOL: B-roll tech. Fallback Pixabay se Pexels 0."""
-    target_duration = min(4.0, avg_scene_duration)
-    
-    def try_pexels():
-        if not PEXELS_API_KEY:
+    def fetch(self, key):
+        """Copia privata (hardlink) della clip normalizzata, o None se assente."""
+        if not self.enabled:
+            return None
+        entry = self._entry_path(key)
+        dst = scratch_path(".mp4")
+        try:
+            self._link_or_copy(entry, dst)
+            os.utime(entry)
+        except FileNotFoundError:
+            self._count(False)
             return None
-        headers = {"Authorization": PEXELS_API_KEY}
-        params = {
-            "query": f"{query} laptop coding ai tool technology workflow",
-            "orientation": "landscape",
-            "per_page": 25,
-            "page": random.randint(1, 3),
+        self._count(True)
+        return dst
+
+    def store(self, key, src):
+        """Pubblica `src` nella cache (atomico anche fra processi)."""
+        if not self.enabled:
+            return
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = f"{entry}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        try:
+            self._link_or_copy(src, tmp)
+            os.replace(tmp, entry)
+        except OSError as e:
+            logger.warning(f"⚠️ Clip cache store fallito: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(".mp4"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        with open(os.path.join(self.root, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _mtime, size, _path in entries)
+            for _mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self._hits, self._misses
+        total = hits + misses
+        entries = self._entries() if self.enabled else []
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "entries": len(entries),
+            "bytes": sum(size for _mtime, size, _path in entries),
+            "max_bytes": self.max_bytes,
         }
-        resp = requests.get("https://api.pexels.com/videos/search", headers=headers, params=params, timeout=20)
+
+CLIP_CACHE = ClipCache(CLIP_CACHE_DIR, CLIP_CACHE_MAX_BYTES)
+
+def pick_rendition(renditions, min_width=0, profile="final"):
+    """Sceglie la rendition più piccola che copre la risoluzione del profilo, altrimenti la più grande.
+
+    `renditions` è una lista di (width, height, url); ritorna la tupla scelta o None.
+    """
+    usable = [(w or 0, h or 0, url) for w, h, url in renditions if url and (w or 0) >= min_width]
+    if not usable:
+        return None
+    target = RENDER_PROFILES[profile]
+    covering = [r for r in usable if r[0] >= target["width"] and r[1] >= target["height"]]
+    if covering:
+        return min(covering, key=lambda r: r[0] * r[1])
+    return max(usable, key=lambda r: r[0] * r[1])
+
+def _download_full(url: str) -> str:
+    tmp_clip = open(scratch_path(".mp4"), "wb")
+    try:
+        clip_resp = http_session("download", FETCH_WORKERS).get(url, stream=True, timeout=30)
+        clip_resp.raise_for_status()
+        for chunk in clip_resp.iter_content(chunk_size=1024 * 1024):
+            if chunk:
+                tmp_clip.write(chunk)
+        tmp_clip.close()
+        size = os.path.getsize(tmp_clip.name)
+        METRICS.inc("video_download_bytes_total", {"mode": "full"}, size)
+        current_timer().add("download", bytes=size)
+    except Exception:
+        tmp_clip.close()
+        os.unlink(tmp_clip.name)
+        raise
+    return tmp_clip.name
+
+def _download_segment(url: str, duration: float) -> str:
+    """Solo i primi `duration` secondi: ffmpeg legge la sorgente HTTP con Range request."""
+    tmp_clip = scratch_path(".mp4")
+    try:
+        run_ffmpeg([
+            "ffmpeg", "-y", "-loglevel", "error", "-t", f"{duration + 0.5:.2f}", "-i", url,
+            "-map", "0:v:0", "-c", "copy", "-an", tmp_clip
+        ], "download", timeout=120)
+        size = os.path.getsize(tmp_clip)
+        if size <= 1000:
+            raise RuntimeError("segmento vuoto")
+        METRICS.inc("video_download_bytes_total", {"mode": "segment"}, size)
+        current_timer().add("download", bytes=size)
+    except Exception:
+        try:
+            os.unlink(tmp_clip)
+        except OSError:
+            pass
+        raise
+    return tmp_clip
+
+def download_file(url: str, duration: float = None) -> str:
+    """Scarica la clip; con `duration` prova prima a prendere solo il segmento necessario."""
+    started = time.perf_counter()
+    try:
+        if SEGMENT_FETCH and duration:
+            try:
+                return _download_segment(url, duration)
+            except Exception as e:
+                logger.warning(f"⚠️ Download parziale fallito, scarico tutto: {e}")
+        return _download_full(url)
+    finally:
+        current_timer().add("download", wall=time.perf_counter() - started)
+
+def acquire_clip(source_id: str, url: str, duration: float, profile="final", final_source=None):
+    """Clip già normalizzata dalla clip cache, altrimenti download della sorgente."""
+    cache_key = CLIP_CACHE.key(source_id, normalize_args(duration, profile))
+    clip = {"final_source": final_source or [source_id, url], "profile": profile, "cache_key": cache_key}
+    cached = CLIP_CACHE.fetch(cache_key)
+    if cached:
+        return dict(clip, path=cached, normalized=True)
+    return dict(clip, path=download_file(url, duration), normalized=False)
+
+def scene_clip_duration(avg_scene_duration):
+    """Ogni clip copre tutta la sua scena: le scene del piano riempiono l'audio senza loop
+    e la scena i parte al suo timestamp (i × durata media). Stessa durata per taglio e download."""
+    return round(avg_scene_duration, 2)
+
+def rendition_candidate(prefix, renditions, profile, min_width=0):
+    """(source_id, url, final_source) per il profilo; `final_source` è la rendition
+    che userà il final se la draft viene promossa."""
+    rendition = pick_rendition(renditions, min_width=min_width, profile=profile)
+    if not rendition:
+        return None
+    final = rendition if profile == "final" else pick_rendition(renditions, min_width=min_width)
+    source_id = f"{prefix}:{rendition[0]}x{rendition[1]}"
+    return source_id, rendition[2], [f"{prefix}:{final[0]}x{final[1]}", final[2]]
+
+def pexels_candidates(query, deadline=None, profile="final"):
+    """Clip Pexels idonee per `query`, in ordine casuale: lista di (source_id, url, final_source)."""
+    if not PEXELS_API_KEY:
+        return []
+    headers = {"Authorization": PEXELS_API_KEY}
+    params = {
+        "query": f"{query} laptop coding ai tool technology workflow",
+        "orientation": "landscape",
+        "per_page": 25,
+        "page": random.randint(1, 3),
+    }
+    videos = SEARCH_CACHE.get("pexels", params["query"], params["page"])
+    if videos is None:
+        resp = PROVIDER_LIMITERS["pexels"].get(
+            PEXELS_SEARCH_URL, deadline=deadline, headers=headers, params=params, timeout=20
+        )
         if resp.status_code != 200:
-            return None
+            return []
         videos = resp.json().get("videos", [])
-        tech_videos = [v for v in videos if is_ai_tool_video_metadata(v, "pexels")]
-        print(f"🎯 Pexels: {len(videos)} totali → {len(tech_videos)} OK (no banned)", flush=True)
-        if tech_videos:
-            video = random.choice(tech_videos)
-            for vf in video.get("video_files", []):
-                if vf.get("width", 0) >= 1280:
-                    return download_file(vf["link"])
-        return None
-    
-    def try_pixabay():
-        if not PIXABAY_API_KEY:
-            return None
-        params = {
-            "key": PIXABAY_API_KEY,
-            "q": f"{query} laptop coding ai tool technology workflow",
-            "per_page": 25,
-            "safesearch": "true",
-            "min_width": 1280,
-        }
-        resp = requests.get("https://pixabay.com/api/videos/", params=params, timeout=20)
+        SEARCH_CACHE.put("pexels", params["query"], params["page"], videos)
+    tech_videos = [v for v in videos if is_ai_tool_video_metadata(v, "pexels")]
+    logger.debug(f"🎯 Pexels: {len(videos)} totali → {len(tech_videos)} OK (no banned)")
+    random.shuffle(tech_videos)
+    candidates = []
+    for video in tech_videos:
+        candidate = rendition_candidate(
+            f"pexels:{video.get('id')}",
+            [(vf.get("width"), vf.get("height"), vf.get("link")) for vf in video.get("video_files", [])],
+            profile, min_width=1280,
+        )
+        if candidate:
+            candidates.append(candidate)
+    return candidates
+
+def pixabay_candidates(query, deadline=None, profile="final"):
+    """Clip Pixabay idonee per `query`, nell'ordine della ricerca: lista di (source_id, url, final_source)."""
+    if not PIXABAY_API_KEY:
+        return []
+    params = {
+        "key": PIXABAY_API_KEY,
+        "q": f"{query} laptop coding ai tool technology workflow",
+        "per_page": 25,
+        "safesearch": "true",
+        "min_width": 1280,
+    }
+    hits = SEARCH_CACHE.get("pixabay", params["q"])
+    if hits is None:
+        resp = PROVIDER_LIMITERS["pixabay"].get(
+            PIXABAY_SEARCH_URL, deadline=deadline, params=params, timeout=20
+        )
         if resp.status_code != 200:
-            return None
+            return []
         hits = resp.json().get("hits", [])
-        for hit in hits:
-            if is_ai_tool_video_metadata(hit, "pixabay"):
-                videos = hit.get("videos", {})
-                for quality in ["large", "medium", "small"]:
-                    if quality in videos and "url" in videos[quality]:
-                        return download_file(videos[quality]["url"])
-        return None
+        SEARCH_CACHE.put("pixabay", params["q"], 1, hits)
+    candidates = []
+    for hit in hits:
+        if is_ai_tool_video_metadata(hit, "pixabay"):
+            videos = hit.get("videos", {})
+            candidate = rendition_candidate(f"pixabay:{hit.get('id')}", [
+                (videos[q].get("width"), videos[q].get("height"), videos[q].get("url"))
+                for q in ["large", "medium", "small"] if q in videos
+            ], profile)
+            if candidate:
+                candidates.append(candidate)
+    return candidates
+
+CLIP_PROVIDERS = (("Pexels", pexels_candidates), ("Pixabay", pixabay_candidates))
+
+def search_candidates(query, deadline=None, profile="final"):
+    """Candidati del primo provider che ne trova (Pexels, fallback Pixabay)."""
+    for source_name, func in CLIP_PROVIDERS:
+        try:
+            candidates = func(query, deadline, profile)
+            if candidates:
+                return candidates
+        except Exception as e:
+            logger.warning(f"⚠️ {source_name}: {e}")
+    return []
+
+def fetch_clip_for_scene(scene_number: int, query: str, avg_scene_duration: float, deadline=None,
+                         profile="final", source=None):
+    """🎯 Canale AI TOOL: B-roll tech. Fallback Pixabay se Pexels 0.
+
+    Con `source` = [source_id, url] (selezione di una draft promossa) riusa quella clip.
+    Ritorna un dict {scene, path, duration, normalized, cache_key, final_source, profile} oppure None.
+    """
+    target_duration = scene_clip_duration(avg_scene_duration)
     
-    for source_name, func in [("Pexels", try_pexels), ("Pixabay", try_pixabay)]:
+    if source:
         try:
-            path = func()
-            if path:
-                print(f"🎥 Scena {scene_number}: '{query[:40]}...' → {source_name} ✓", flush=True)
-                return path, target_duration
+            clip = acquire_clip(source[0], source[1], target_duration, profile)
+            clip["scene"] = scene_number
+            clip["duration"] = target_duration
+            return clip
+        except Exception as e:
+            logger.warning(f"⚠️ Clip selezionata {source[0]} non disponibile, nuova ricerca: {e}")
+    
+    for source_name, func in CLIP_PROVIDERS:
+        try:
+            candidates = func(query, deadline, profile)
+            if candidates:
+                source_id, url, final_source = candidates[0]
+                clip = acquire_clip(source_id, url, target_duration, profile, final_source)
+                cached = " (cache)" if clip["normalized"] else ""
+                logger.info(f"🎥 Scena {scene_number}: '{query[:40]}...' → {source_name} ✓{cached}")
+                clip["scene"] = scene_number
+                clip["duration"] = target_duration
+                return clip
+        except Exception as e:
+            logger.warning(f"⚠️ {source_name}: {e}")
+    
+    logger.warning(f"⚠️ NO CLIP per scena {scene_number}: '{query}'")
+    return None
+
+# -------------------------------------------------
+# Normalizzazione parallela con budget di thread ffmpeg condiviso fra job
+# -------------------------------------------------
+# Slot ffmpeg globali: job concorrenti se li spartiscono, quindi i thread totali
+# restano NORMALIZE_PARALLEL × FFMPEG_THREADS ≈ FFMPEG_CPU_BUDGET.
+_normalize_slots = BoundedSemaphore(max(1, NORMALIZE_PARALLEL))
+
+def normalize_clip(clip):
+    """Normalizza una clip (o usa quella già in cache); solleva RuntimeError se fallisce."""
+    if clip["normalized"]:
+        return clip["path"]
+    normalized_path = scratch_path(".mp4")
+    try:
+        with _normalize_slots:
+            result = run_ffmpeg([
+                "ffmpeg", "-y", "-loglevel", "error", "-i", clip["path"],
+                *normalize_args(clip["duration"], clip.get("profile", "final")), "-threads", str(FFMPEG_THREADS), normalized_path
+            ], "normalize", check=False)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg exit {result.returncode}: {result.stderr.strip()[-300:]}")
+        if not os.path.exists(normalized_path) or os.path.getsize(normalized_path) <= 1000:
+            raise RuntimeError("output vuoto")
+    except Exception:
+        try:
+            os.unlink(normalized_path)
+        except OSError:
+            pass
+        raise
+    CLIP_CACHE.store(clip["cache_key"], normalized_path)
+    return normalized_path
+
+def publish_completion(futures, event):
+    """Pubblica `event` con done/total man mano che i future del job terminano."""
+    publish = progress_publisher()
+    lock = Lock()
+    done = [0]
+    def on_done(future):
+        with lock:
+            done[0] += 1
+            count = done[0]
+        publish(event, done=count, total=len(futures), ok=not future.cancelled() and future.exception() is None)
+    for future in futures:
+        future.add_done_callback(on_done)
+
+def normalize_clips_parallel(clips, checkpoint=None):
+    """Normalizza le clip in parallelo; ritorna (path in ordine di scena, fallimenti).
+
+    Con `checkpoint` ogni clip pronta entra subito nel manifest e la sua sorgente
+    viene cancellata: un resume a metà stage non la rifà e non la perde.
+    """
+    def normalize(clip):
+        path = normalize_clip(clip)
+        if checkpoint is None or clip["normalized"]:
+            return path
+        return checkpoint.record_normalized(clip, path)
+    
+    with ThreadPoolExecutor(max_workers=max(1, NORMALIZE_PARALLEL), thread_name_prefix="normalize") as executor:
+        task = with_job_context(normalize)
+        futures = [executor.submit(task, clip) for clip in clips]
+        publish_completion(futures, "normalize")
+    normalized = []
+    failures = []
+    for clip, future in zip(clips, futures):
+        try:
+            normalized.append(future.result())
         except Exception as e:
-            print(f"⚠️ {source_name}: {e}", flush=True)
+            logger.warning(f"⚠️ Normalizzazione scena {clip.get('scene')} fallita: {e}")
+            failures.append({"scene": clip.get("scene"), "error": str(e)[:300]})
+    return normalized, failures
+
+def build_concat_entries(clip_durations, target_duration):
+    """Ripete le clip in ordine finché la somma delle durate copre `target_duration`."""
+    entries = []
+    total = 0.0
+    while clip_durations and total < target_duration:
+        for path, duration in clip_durations:
+            entries.append(path)
+            total += max(duration, 0.1)
+            if total >= target_duration:
+                break
+    return entries
+
+def _discard_late_clip(future):
+    """Clip arrivata dopo la deadline: nessuno la userà, cancella il file."""
+    try:
+        clip = future.result()
+        if clip:
+            os.unlink(clip["path"])
+    except Exception:
+        pass
+
+def fetch_clips_parallel(scene_assignments, avg_scene_duration, profile="final"):
+    """Scarica le clip in parallelo (limiti per provider) e le ritorna in ordine di scena."""
+    deadline = time.monotonic() + FETCH_DEADLINE
+    executor = ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS), thread_name_prefix="clip-fetch")
+    task = with_job_context(fetch_clip_for_scene)
+    futures = [
+        executor.submit(task, a["scene"], a["query"], avg_scene_duration, deadline, profile, a.get("source"))
+        for a in scene_assignments
+    ]
+    publish_completion(futures, "acquire")
+    futures_wait(futures, timeout=FETCH_DEADLINE)
+    executor.shutdown(wait=False, cancel_futures=True)
     
-    print(f"⚠️ NO CLIP per scena {scene_number}: '{query}'", flush=True)
-    return None, None
+    results = []
+    late = 0
+    for future in futures:
+        if not future.done():
+            late += 1
+            future.add_done_callback(_discard_late_clip)
+            continue
+        if future.cancelled():
+            late += 1
+            continue
+        try:
+            clip = future.result()
+        except Exception as e:
+            logger.warning(f"⚠️ Errore acquisizione clip: {e}")
+            continue
+        if clip:
+            results.append(clip)
+    if late:
+        logger.warning(f"⏰ Deadline acquisizione ({FETCH_DEADLINE}s): {late} scene saltate")
+    return results
+
+# -------------------------------------------------
+# Ingestione audio in streaming: il job tiene solo il path del file su disco
+# -------------------------------------------------
+AUDIO_PAYLOAD_FIELDS = ("audio_base64", "audiobase64")
+SPOOL_CHUNK = 1024 * 1024
+
+def audio_spool_path(job_id):
+    os.makedirs(AUDIO_SPOOL_DIR, exist_ok=True)
+    return os.path.join(AUDIO_SPOOL_DIR, f"{job_id}.bin")
+
+def spool_stream(stream, path):
+    """Copia uno stream su disco a chunk; ritorna i byte scritti."""
+    written = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = stream.read(SPOOL_CHUNK)
+            if not chunk:
+                break
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+def spool_base64(text, path):
+    """Decodifica base64 su disco a blocchi (allineati a 4 caratteri)."""
+    if "\n" in text or "\r" in text or " " in text:
+        text = "".join(text.split())
+    step = 4 * SPOOL_CHUNK // 3 // 4 * 4
+    written = 0
+    with open(path, "wb") as f:
+        for i in range(0, len(text), step):
+            chunk = base64.b64decode(text[i:i + step])
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+def spool_url(url, path):
+    """Scarica l'audio referenziato da `audio_url` direttamente su disco."""
+    resp = http_session("audio", 4).get(url, stream=True, timeout=60)
+    resp.raise_for_status()
+    with open(path, "wb") as f:
+        for chunk in resp.iter_content(chunk_size=SPOOL_CHUNK):
+            if chunk:
+                f.write(chunk)
+    return path
+
+def ingest_request(job_id):
+    """Legge la richiesta /generate e mette l'audio su disco.
+
+    Formati accettati:
+    - multipart/form-data: file `audio` + campi form (o un campo `payload` JSON)
+    - body raw (audio/* o application/octet-stream): metadati in query string
+    - JSON con `audio_url` (scaricato dal worker) o `audio_base64` (legacy)
+    Ritorna il dict `data` senza l'audio, con `audio_path` se già su disco.
+    """
+    content_type = (request.mimetype or "").lower()
+    path = audio_spool_path(job_id)
+    try:
+        if content_type == "multipart/form-data":
+            data = json.loads(request.form["payload"]) if "payload" in request.form else request.form.to_dict()
+            upload = request.files.get("audio")
+            if upload:
+                upload.save(path, buffer_size=SPOOL_CHUNK)
+                data["audio_path"] = path
+        elif content_type.startswith("audio/") or content_type == "application/octet-stream":
+            data = request.args.to_dict()
+            if spool_stream(request.stream, path):
+                data["audio_path"] = path
+        else:
+            data = request.get_json(force=True) or {}
+            audio_b64 = None
+            for field in AUDIO_PAYLOAD_FIELDS:
+                audio_b64 = data.pop(field, None) or audio_b64
+            if audio_b64:
+                spool_base64(audio_b64, path)
+                data["audio_path"] = path
+    except Exception:
+        discard_spooled_audio({"audio_path": path})
+        raise
+    return data
+
+def sweep_audio_spool(ttl):
+    """Rimuove l'audio in spool di job completati o spariti dallo store.
+
+    Un job fallito prima di partire (budget disco, batch, resume) lo tiene finché
+    resta nello store, così /resume lo ritrova; i file senza job aspettano `ttl`
+    (l'audio viene scritto prima che il job esista).
+    """
+    removed = 0
+    cutoff = time.time() - ttl
+    try:
+        names = os.listdir(AUDIO_SPOOL_DIR)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(AUDIO_SPOOL_DIR, name)
+        job = jobs.get(name[:-len(".bin")]) if name.endswith(".bin") else None
+        try:
+            stale = os.path.getmtime(path) < cutoff
+        except OSError:
+            continue
+        if job is None and stale or job is not None and job.get("status") == "completed":
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def discard_spooled_audio(data):
+    path = data.get("audio_path")
+    if path:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+@app.before_request
+def start_background_services():
+    # thread di servizio avviati nel processo worker (dopo il fork di gunicorn)
+    start_job_sweeper()
+    OUTBOX.ensure_started()
+    if RESUME_ON_START:
+        resume_orphaned_jobs()
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "healthy", "jobs": len(jobs)})
+    # coda, cache in memoria ed eventi sono del worker gunicorn che ha risposto
+    return jsonify({
+        "status": "healthy",
+        "jobs": len(jobs),
+        "worker": current_worker(),
+        "gunicorn_workers": WEB_CONCURRENCY,
+        "queue": dict(scheduler.stats(), scope="worker", max_concurrent_total=MAX_CONCURRENT, max_queue_total=MAX_QUEUE),
+        "search_cache": SEARCH_CACHE.stats(),
+        "clip_cache": CLIP_CACHE.stats(),
+        "workspace": WORKSPACE_BUDGET.stats(),
+        "events": EVENTS.stats(),
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    queue = scheduler.stats()
+    body = METRICS.render(gauges=[
+        ("video_queue_length", "Job in coda in questo processo", queue["queued"]),
+        ("video_jobs_running", "Job in esecuzione in questo processo", queue["running"]),
+        ("video_queue_wait_seconds_avg", "Attesa media in coda (ultimi 100 job)", queue["avg_wait_seconds"]),
+    ])
+    return Response(body, mimetype="text/plain; version=0.0.4")
 
 @app.route("/ffmpeg-test", methods=["GET"])
 def ffmpeg_test():
@@ -276,104 +2799,223 @@ def ffmpeg_test():
     firstline = result.stdout.splitlines()[0] if result.stdout else "no output"
     return jsonify({"ffmpeg_output": firstline})
 
-@app.route("/status/<job_id>", methods=["GET"])
-def get_status(job_id):
-    job = jobs.get(job_id)
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    
+def wait_for_progress(job_id, status, after, timeout):
+    """Aspetta nuovi eventi del job o un cambio di stato nel job store (job su un altro worker)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        events = EVENTS.wait(job_id, after, timeout=max(0.0, min(5.0, remaining)))
+        job = jobs.get(job_id)
+        if events or job is None or job["status"] != status or remaining <= 5.0:
+            return events, job
+
+def store_queue_position(job):
+    """Posizione di un job accodato da un altro worker gunicorn, ricostruita dal job store.
+
+    Stesso ordine dello scheduler (priorità, poi arrivo); l'ETA usa le medie di questo worker.
+    """
+    def order(j):
+        return -job_priority(j.get("data") or {}), j.get("created_at") or ""
+    owner = job.get("worker")
+    ahead = [
+        j for j in jobs.active()
+        if j.get("status") == "queued" and j.get("worker") == owner and order(j) < order(job)
+    ]
+    return len(ahead) + 1
+
+def waiters_exhausted():
+    """503 per /events e /status?wait= oltre EVENTS_MAX_WAITERS."""
+    resp = jsonify({
+        "error": f"Troppi client in attesa ({EVENTS.max_waiters} per worker): riprovare o usare /status senza wait",
+    })
+    resp.headers["Retry-After"] = "5"
+    return resp, 503
+
+def status_payload(job_id, job):
     response = {
         "job_id": job_id,
         "status": job["status"],
         "created_at": job.get("created_at")
     }
+    if job['status'] == 'queued':
+        position = scheduler.position(job_id)
+        if position is None and job.get("worker") not in (None, current_worker()):
+            position = store_queue_position(job)
+        if position:
+            response['queue_position'] = position
+            response['eta_seconds'] = scheduler.eta(position)
     if job['status'] == 'completed':
         response['video_url'] = job.get('video_url')
         response['duration'] = job.get('duration')
         response['clips_used'] = job.get('clips_used')
     elif job['status'] == 'failed':
         response['error'] = job.get('error')
+    if job.get('normalize_failures'):
+        response['normalize_failures'] = job['normalize_failures']
+    if job.get('timings'):
+        response['timings'] = job['timings']
+    if job.get('upload'):
+        response['upload'] = job['upload']
+    if job.get('sheets'):
+        response['sheets'] = job['sheets']
+    response['profile'] = (job.get('data') or {}).get('profile') or DEFAULT_PROFILE
+    for field in ('promoted_from', 'promoted_to'):
+        if job.get(field):
+            response[field] = job[field]
+    if job.get('checkpoint') and job['status'] != 'completed':
+        response['checkpoint'] = job['checkpoint']
+    if job.get('resumed'):
+        response['resumed'] = job['resumed']
+    webhook = OUTBOX.status_for(job_id)
+    if webhook:
+        response['webhook'] = webhook
+    return response
+
+@app.route("/status/<job_id>", methods=["GET"])
+def get_status(job_id):
+    """Stato del job; con `?wait=<s>` long-poll fino al prossimo evento (`?after=<id evento>`)."""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
     
+    wait = request.args.get("wait", type=float)
+    after = request.args.get("after", default=0, type=int)
+    if wait and job["status"] not in FINAL_STATUSES:
+        if not EVENTS.acquire_waiter():
+            return waiters_exhausted()
+        try:
+            events, current = wait_for_progress(job_id, job["status"], after, min(wait, STATUS_MAX_WAIT))
+        finally:
+            EVENTS.release_waiter()
+        job = current or job
+    else:
+        events = EVENTS.since(job_id, after)
+    response = status_payload(job_id, job)
+    if wait is not None or "after" in request.args:
+        response['events'] = events
+        response['last_event_id'] = events[-1]["id"] if events else after
     return jsonify(response)
 
-def process_video_async(job_id, data):
-    """Processa video in background thread"""
-    job = jobs[job_id]
-    job["status"] = "processing"
-    # memorizza info per il webhook n8n flusso 2
-    job["job_id"] = job_id
-    job["data"] = data
+def sse_message(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+@app.route("/events/<job_id>", methods=["GET"])
+def job_events(job_id):
+    """Server-sent events: stage, clip acquisite/normalizzate, % di encode, byte caricati.
+
+    Chiude lo stream quando il job è completato o fallito; riprende da `Last-Event-ID`.
+    Al massimo EVENTS_MAX_WAITERS stream aperti per worker, poi 503.
+    """
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if not EVENTS.acquire_waiter():
+        return waiters_exhausted()
+    after = request.headers.get("Last-Event-ID", type=int) or request.args.get("after", default=0, type=int)
     
-    audiopath = None
-    audio_wav_path = None
-    video_looped_path = None
-    final_video_path = None
-    scene_paths = []
+    def stream():
+        status = job["status"]
+        yield sse_message("snapshot", status_payload(job_id, job))
+        last = after
+        while status not in FINAL_STATUSES:
+            events, current = wait_for_progress(job_id, status, last, EVENTS_HEARTBEAT)
+            for event in events:
+                last = event["id"]
+                if event["event"] == "status":
+                    status = event["status"]
+                yield sse_message(event["event"], event, event["id"])
+            if current is None:
+                return
+            if not events:
+                if current["status"] != status:
+                    # job eseguito da un altro worker: lo stato arriva dal job store
+                    status = current["status"]
+                    yield sse_message("status", status_payload(job_id, current))
+                else:
+                    yield ": keepalive\n\n"
     
-    try:
-        if not all([R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME, R2_PUBLIC_BASE_URL]):
-            raise RuntimeError("Config R2 mancante")
-        
-        audiobase64 = data.get("audio_base64") or data.get("audiobase64")
-        raw_script = (data.get("script") or data.get("script_chunk") or data.get("script_audio") or data.get("script_completo") or "")
-        script = (" ".join(str(p).strip() for p in raw_script) if isinstance(raw_script, list) else str(raw_script).strip())
-        raw_keywords = data.get("keywords", "")
-        sheet_keywords = (", ".join(str(k).strip() for k in raw_keywords) if isinstance(raw_keywords, list) else str(raw_keywords).strip())
-        
-        row_number_raw = data.get("row_number")
-        if isinstance(row_number_raw, dict):
-            row_number = int(row_number_raw.get('row', row_number_raw.get('row_number', 1)))
-        elif isinstance(row_number_raw, str):
-            row_number = int(row_number_raw) if row_number_raw.isdigit() else 1
-        elif isinstance(row_number_raw, (int, float)):
-            row_number = int(row_number_raw)
-        else:
-            row_number = 1
+    resp = Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # il posto si libera quando il server chiude la risposta (fine stream o client disconnesso)
+    resp.call_on_close(EVENTS.release_waiter)
+    return resp
 
-        print("=" * 80, flush=True)
-        print(f"🎬 START AI TOOL MASTER: {len(script)} char script, keywords: '{sheet_keywords}', row: {row_number}", flush=True)
-        print(f"🔍 DEBUG row_number RAW: '{row_number_raw}' → PARSED: '{row_number}'", flush=True)
-        print(f"🔍 DEBUG GOOGLE_CREDENTIALS_JSON: {'PRESENTE ({len(GOOGLE_CREDENTIALS_JSON)} char)' if GOOGLE_CREDENTIALS_JSON else 'MANCANTE'}", flush=True)
-        
-        if not audiobase64:
-            raise RuntimeError("audiobase64 mancante")
-        
-        # (tutto il resto della funzione process_video_async RESTA UGUALE
-        # fino al punto in cui fai job.update({...}) e il cleanup)
-        
-                # Audio processing
-        audio_bytes = base64.b64decode(audiobase64)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".bin") as f:
-            f.write(audio_bytes)
-        audiopath_tmp = f.name
-        
-        audio_wav_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-        audio_wav_path = audio_wav_tmp.name
-        audio_wav_tmp.close()
+def parse_job_fields(data):
+    """Script, keywords e riga dello sheet dal payload n8n (formati variabili)."""
+    raw_script = (data.get("script") or data.get("script_chunk") or data.get("script_audio") or data.get("script_completo") or "")
+    script = (" ".join(str(p).strip() for p in raw_script) if isinstance(raw_script, list) else str(raw_script).strip())
+    raw_keywords = data.get("keywords", "")
+    sheet_keywords = (", ".join(str(k).strip() for k in raw_keywords) if isinstance(raw_keywords, list) else str(raw_keywords).strip())
+    
+    row_number_raw = data.get("row_number")
+    if isinstance(row_number_raw, dict):
+        row_number = int(row_number_raw.get('row', row_number_raw.get('row_number', 1)))
+    elif isinstance(row_number_raw, str):
+        row_number = int(row_number_raw) if row_number_raw.isdigit() else 1
+    elif isinstance(row_number_raw, (int, float)):
+        row_number = int(row_number_raw)
+    else:
+        row_number = 1
+
+    logger.debug("=" * 80)
+    logger.info(f"🎬 START AI TOOL MASTER: {len(script)} char script, keywords: '{sheet_keywords}', row: {row_number}")
+    logger.debug(f"🔍 DEBUG row_number RAW: '{row_number_raw}' → PARSED: '{row_number}'")
+    logger.debug(f"🔍 DEBUG GOOGLE_CREDENTIALS_JSON: {'PRESENTE ({len(GOOGLE_CREDENTIALS_JSON)} char)' if GOOGLE_CREDENTIALS_JSON else 'MANCANTE'}")
+    return script, sheet_keywords, row_number
+
+def ingest_audio(checkpoint, data):
+    """Stage ingest: l'audio ricevuto entra nel workspace e nel manifest (teardown lo tiene)."""
+    if data.get("audio_path") and os.path.exists(data["audio_path"]):
+        checkpoint.save("ingest", path=checkpoint.adopt(data["audio_path"], "source.bin"))
+
+def prepare_audio(checkpoint, data):
+    """Stage audio: WAV 48k + durata, dal checkpoint se già fatto."""
+    audio = checkpoint.done("audio", "path")
+    if audio is None:
+        audio_source = checkpoint.path("source.bin")
+        ingest_audio(checkpoint, data)
+        if not os.path.exists(audio_source):
+            if not data.get("audio_url"):
+                raise RuntimeError("audio mancante (audio_base64, file audio o audio_url)")
+            spooled = spool_url(data["audio_url"], checkpoint.scratch(".bin"))
+            checkpoint.save("ingest", path=checkpoint.adopt(spooled, "source.bin"))
         
-        subprocess.run([
-            "ffmpeg", "-y", "-loglevel", "error", "-i", audiopath_tmp,
+        current_timer().begin("audio")
+        audio_wav_path = checkpoint.path("audio.wav")
+        run_ffmpeg([
+            "ffmpeg", "-y", "-loglevel", "error", "-i", audio_source,
             "-acodec", "pcm_s16le", "-ar", "48000", audio_wav_path
-        ], timeout=MAX_DURATION, check=True)
-        os.unlink(audiopath_tmp)
-        audiopath = audio_wav_path
+        ], "audio")
         
         probe = subprocess.run([
             "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", audiopath
+            "-of", "default=noprint_wrappers=1:nokey=1", audio_wav_path
         ], stdout=subprocess.PIPE, text=True, timeout=10)
-        real_duration = float(probe.stdout.strip() or 720.0)
-        print(f"⏱️ Durata audio: {real_duration/60:.1f}min ({real_duration:.0f}s)", flush=True)
-        
+        audio = {"path": audio_wav_path, "duration": float(probe.stdout.strip() or 720.0)}
+        checkpoint.save("audio", **audio)
+        os.unlink(audio_source)
+    logger.info(f"⏱️ Durata audio: {audio['duration']/60:.1f}min ({audio['duration']:.0f}s)")
+    return audio
+
+def plan_scenes(checkpoint, script, sheet_keywords, real_duration, profile="final"):
+    """Stage plan: una query visuale per ogni scena (MAX_CLIPS scalato dal profilo)."""
+    plan = checkpoint.done("plan")
+    if plan is None:
+        current_timer().begin("plan")
         script_words = script.lower().split()
         words_per_second = (len(script_words) / real_duration if real_duration > 0 else 2.5)
-        num_scenes = MAX_CLIPS
+        num_scenes = max(5, round(MAX_CLIPS * RENDER_PROFILES[profile]["clip_share"]))
         avg_scene_duration = real_duration / num_scenes
         scene_assignments = []
         
         for i in range(num_scenes):
             if i % 10 == 0:
-                print(f"🔧 Clip {i}/{num_scenes}", flush=True)
+                logger.debug(f"🔧 Clip {i}/{num_scenes}")
             timestamp = i * avg_scene_duration
             word_index = int(timestamp * words_per_second)
             scene_context = " ".join(script_words[word_index: word_index + 7]) if word_index < len(script_words) else "ai tool technology laptop coding workflow"
@@ -382,176 +3024,682 @@ def process_video_async(job_id, data):
                 "scene": i + 1, "timestamp": round(timestamp, 1),
                 "context": scene_context[:60], "query": scene_query[:80]
             })
+        plan = {"scenes": scene_assignments, "avg_scene_duration": avg_scene_duration}
+        checkpoint.save("plan", **plan)
+    return plan
+
+def acquire_scenes(checkpoint, scene_assignments, avg_scene_duration, profile="final"):
+    """Stage acquire (o parte): scarica le clip delle scene e le sposta nel workspace."""
+    clips = fetch_clips_parallel(scene_assignments, avg_scene_duration, profile)
+    for clip in clips:
+        clip["path"] = checkpoint.adopt(clip["path"], f"scene_{clip['scene']:03d}.src.mp4")
+    return clips
+
+def process_video_async(job_id, data):
+    """Processa video in background thread (riprende dagli stage già in checkpoint)"""
+    # memorizza info per il webhook n8n flusso 2
+    jobs.update(job_id, {"status": "processing", "job_id": job_id, "data": data, "worker": current_worker()})
+    EVENTS.publish(job_id, "status", status="processing")
+    timer = JobTimer(job_id)
+    _job_context.timer = timer
+    checkpoint = JobCheckpoint(job_id)
+    _job_context.workspace = checkpoint
+    if checkpoint.stages:
+        logger.info(f"♻️ Resume job {job_id}: stage già completati {list(checkpoint.stages)}")
+    
+    try:
+        # l'audio ricevuto entra subito nel workspace, così un resume lo ritrova
+        ingest_audio(checkpoint, data)
+        if not all([R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME, R2_PUBLIC_BASE_URL]):
+            raise RuntimeError("Config R2 mancante")
         
-        for assignment in scene_assignments:
-            clip_path, clip_dur = fetch_clip_for_scene(
-                assignment["scene"], assignment["query"], avg_scene_duration
-            )
-            if clip_path and clip_dur:
-                scene_paths.append((clip_path, clip_dur))
-        
-        print(f"✅ CLIPS SCARICATE: {len(scene_paths)}/{num_scenes}", flush=True)
-        if len(scene_paths) < 5:
-            raise RuntimeError(f"Troppe poche clip: {len(scene_paths)}/{num_scenes}")
-        
-        normalized_clips = []
-        for i, (clip_path, _dur) in enumerate(scene_paths):
-            try:
-                normalized_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-                normalized_path = normalized_tmp.name
-                normalized_tmp.close()
-                subprocess.run([
-                    "ffmpeg", "-y", "-loglevel", "error", "-i", clip_path,
-                    "-vf", "scale=1920:1080:force_original_aspect_ratio=increase,crop=1920:1080,fps=30",
-                    "-c:v", "libx264", "-preset", "fast", "-crf", "23", "-an", normalized_path
-                ], timeout=MAX_DURATION, check=True)
-                if os.path.exists(normalized_path) and os.path.getsize(normalized_path) > 1000:
-                    normalized_clips.append(normalized_path)
-            except Exception:
-                pass
-        
-        if not normalized_clips:
-            raise RuntimeError("Nessuna clip normalizzata")
+        profile = job_profile(data)
+        script, sheet_keywords, row_number = parse_job_fields(data)
+        s3_client = get_s3_client()
+        uploaded = checkpoint.done("upload")
+        rendered = None if uploaded else checkpoint.done("render", "path")
+        upload_stats = {}
         
-        def get_duration(p):
-            out = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", p
-            ], stdout=subprocess.PIPE, text=True, timeout=10).stdout.strip()
-            return float(out or 4.0)
+        if uploaded is None and rendered is None:
+            audio = prepare_audio(checkpoint, data)
+            audiopath = audio["path"]
+            real_duration = audio["duration"]
+            
+            plan = plan_scenes(checkpoint, script, sheet_keywords, real_duration, profile)
+            scene_assignments = plan["scenes"]
+            avg_scene_duration = plan["avg_scene_duration"]
+            num_scenes = len(scene_assignments)
+            
+            normalized = checkpoint.done("normalize", "paths")
+            if normalized is None:
+                acquired = checkpoint.done("acquire")
+                if acquired is None:
+                    timer.begin("acquire")
+                    scene_paths = acquire_scenes(checkpoint, scene_assignments, avg_scene_duration, profile)
+                    checkpoint.save("acquire", clips=scene_paths)
+                else:
+                    scene_paths = [c for c in acquired["clips"] if c["path"] and os.path.exists(c["path"])]
+                    lost = {c["scene"] for c in acquired["clips"]} - {c["scene"] for c in scene_paths}
+                    if lost:
+                        # clip sparite dal workspace (resume) o mai arrivate (batch, path None):
+                        # si riacquisiscono solo quelle scene, con fallback fra i provider
+                        logger.warning(f"⚠️ Job {job_id}: {len(lost)} clip mancanti nel checkpoint, riacquisizione")
+                        timer.begin("acquire")
+                        scene_paths += acquire_scenes(
+                            checkpoint, [a for a in scene_assignments if a["scene"] in lost], avg_scene_duration, profile
+                        )
+                        scene_paths.sort(key=lambda c: c["scene"])
+                        checkpoint.save("acquire", clips=scene_paths)
+                
+                logger.info(f"✅ CLIPS SCARICATE: {len(scene_paths)}/{num_scenes}")
+                if len(scene_paths) < 5:
+                    raise RuntimeError(f"Troppe poche clip: {len(scene_paths)}/{num_scenes}")
+                
+                # ogni clip normalizzata va nel manifest e la sua sorgente viene cancellata subito
+                timer.begin("normalize")
+                normalized_clips, normalize_failures = normalize_clips_parallel(scene_paths, checkpoint)
+                logger.info(f"✅ CLIPS NORMALIZZATE: {len(normalized_clips)}/{len(scene_paths)} ({FFMPEG_THREADS} thread/ffmpeg, profilo {profile})")
+                if normalize_failures:
+                    jobs.update(job_id, {"normalize_failures": normalize_failures})
+                
+                if not normalized_clips:
+                    raise RuntimeError("Nessuna clip normalizzata")
+                # le clip normalizzate sono già nel workspace e nel manifest: restano dove sono
+                normalized = {"paths": normalized_clips, "clips_used": len(scene_paths)}
+                checkpoint.save("normalize", **normalized)
+                checkpoint.remove(*(clip["path"] for clip in scene_paths if clip["path"] not in normalized_clips))
+            normalized_clips = normalized["paths"]
+            
+            def get_duration(p):
+                out = subprocess.run([
+                    "ffprobe", "-v", "error", "-show_entries", "format=duration",
+                    "-of", "default=noprint_wrappers=1:nokey=1", p
+                ], stdout=subprocess.PIPE, text=True, timeout=10).stdout.strip()
+                return float(out or 4.0)
+            
+            timer.begin("render")
+            # Loop delle clip via lista concat: le clip hanno già tutte lo stesso formato,
+            # quindi concat + mux audio avvengono in un unico passaggio in stream copy.
+            concat_entries = build_concat_entries(
+                [(p, get_duration(p)) for p in normalized_clips], real_duration
+            )
+            if not UPLOAD_STREAMING:
+                # il render è in stream copy: il file finale pesa quanto le clip in lista più l'audio AAC,
+                # quindi il budget si verifica prima di lanciarlo e non a render finito
+                audio_bytes = int(RENDER_PROFILES[profile]["audio_bitrate"].rstrip("k")) * 1000 / 8 * real_duration
+                checkpoint.check_budget(sum(os.path.getsize(p) for p in concat_entries) + int(audio_bytes))
+            concat_list_path = checkpoint.path("concat.txt")
+            with open(concat_list_path, "w") as concat_list:
+                for norm_path in concat_entries:
+                    concat_list.write(f"file '{norm_path}'\n")
+            
+            mux_cmd = [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "concat", "-safe", "0", "-i", concat_list_path, "-i", audiopath,
+                "-map", "0:v", "-map", "1:a", "-c:v", "copy",
+                "-c:a", "aac", "-b:a", RENDER_PROFILES[profile]["audio_bitrate"],
+                "-t", str(real_duration), "-shortest",
+            ]
+            today = dt.datetime.utcnow().strftime("%Y-%m-%d")
+            object_key = f"videos/{today}/{uuid.uuid4().hex}.mp4"
+            if UPLOAD_STREAMING:
+                # MP4 frammentato su pipe: le parti salgono su R2 mentre ffmpeg scrive,
+                # senza file finale su disco; l'oggetto si chiude solo se ffmpeg esce con 0
+                # (altrimenti l'upload viene annullato e run_ffmpeg solleva l'errore)
+                run_ffmpeg(
+                    mux_cmd + ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"],
+                    "render",
+                    stdout_consumer=lambda out, finished: upload_stats.update(
+                        upload_stream(s3_client, R2_BUCKET_NAME, object_key, out, finalize=finished) or {}
+                    ),
+                    progress_duration=real_duration,
+                )
+                uploaded = {
+                    "object_key": object_key,
+                    "public_url": f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key}",
+                    "stats": upload_stats,
+                }
+                checkpoint.save("upload", **uploaded)
+            else:
+                final_video_path = checkpoint.path("final.mp4")
+                run_ffmpeg(mux_cmd + ["-movflags", "+faststart", final_video_path], "render",
+                           progress_duration=real_duration)
+                rendered = {"path": final_video_path}
+                checkpoint.save("render", **rendered)
+            # clip normalizzate e lista concat consumate dal render; il WAV serve ancora solo alle draft
+            checkpoint.remove(concat_list_path, *normalized_clips)
+            if profile != "draft":
+                checkpoint.remove(audiopath)
         
-        total_clips_duration = sum(get_duration(p) for p in normalized_clips)
-        concat_list_tmp = tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".txt")
-        entries_written = 0
-        MAX_CONCAT_ENTRIES = 150
+        if uploaded is None:
+            timer.begin("upload")
+            today = dt.datetime.utcnow().strftime("%Y-%m-%d")
+            object_key = f"videos/{today}/{uuid.uuid4().hex}.mp4"
+            upload_stats = upload_file_multipart(s3_client, R2_BUCKET_NAME, object_key, rendered["path"])
+            uploaded = {
+                "object_key": object_key,
+                "public_url": f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key}",
+                "stats": upload_stats,
+            }
+            checkpoint.save("upload", **uploaded)
+            checkpoint.remove(rendered["path"])
+        if upload_stats:
+            timer.add("upload", bytes=upload_stats["bytes"], parts=upload_stats["parts"])
+            jobs.update(job_id, {"upload": upload_stats})
+        object_key = uploaded["object_key"]
+        public_url = uploaded["public_url"]
+        real_duration = checkpoint.stages["audio"]["duration"]
+        clips_used = checkpoint.stages["normalize"]["clips_used"]
+        R2_INDEX.add(object_key, job_id)
+        RETENTION.trigger()
         
-        if total_clips_duration < real_duration and len(normalized_clips) > 1:
-            loops_needed = math.ceil(real_duration / total_clips_duration)
-            for _ in range(loops_needed):
-                for norm_path in normalized_clips:
-                    if entries_written >= MAX_CONCAT_ENTRIES:
-                        break
-                    concat_list_tmp.write(f"file '{norm_path}'\n")
-                    entries_written += 1
-                if entries_written >= MAX_CONCAT_ENTRIES:
-                    break
+        timer.end()
+        # una draft è solo da revisionare: niente PRODOTTO sullo sheet né webhook di
+        # pubblicazione, li scrive il job final creato da /promote
+        if profile != "draft" and row_number > 0 and get_gspread_client() is not None:
+            # M = Video_URL, B = PRODOTTO (anti-loop): scritti in batch dal SheetsWriter
+            SHEETS.enqueue(job_id, [(row_number, 13, public_url), (row_number, 2, "PRODOTTO")])
+            logger.info(f"📊 Sheet row {row_number} in coda: M={public_url[:60]} + B=PRODOTTO (anti-loop)")
+
+        if profile == "draft":
+            # audio, piano e selezione clip restano per un'eventuale /promote
+            checkpoint.retain("audio.wav")
         else:
-            for norm_path in normalized_clips:
-                concat_list_tmp.write(f"file '{norm_path}'\n")
-                entries_written += 1
-        
-        concat_list_tmp.close()
-        
-        video_looped_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-        video_looped_path = video_looped_tmp.name
-        video_looped_tmp.close()
-        
-        subprocess.run([
-            "ffmpeg", "-y", "-loglevel", "error",
-            "-f", "concat", "-safe", "0", "-i", concat_list_tmp.name,
-            "-vf", "fps=30,format=yuv420p", "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-            "-t", str(real_duration), video_looped_path
-        ], timeout=MAX_DURATION, check=True)
-        os.unlink(concat_list_tmp.name)
-        
-        final_video_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-        final_video_path = final_video_tmp.name
-        final_video_tmp.close()
+            checkpoint.discard()
         
-        subprocess.run([
-            "ffmpeg", "-y", "-loglevel", "error",
-            "-i", video_looped_path, "-i", audiopath,
-            "-filter_complex", "[0:v]scale=1920:1080:force_original_aspect_ratio=increase,crop=1920:1080,format=yuv420p[v]",
-            "-map", "[v]", "-map", "1:a", "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-            "-c:a", "aac", "-b:a", "192k", "-shortest", final_video_path
-        ], timeout=MAX_DURATION, check=True)
+        logger.info(f"✅ 🎬 VIDEO AI TOOL MASTER COMPLETO: {real_duration/60:.1f}min → {public_url}")
         
-        s3_client = get_s3_client()
-        today = dt.datetime.utcnow().strftime("%Y-%m-%d")
-        object_key = f"videos/{today}/{uuid.uuid4().hex}.mp4"
-        s3_client.upload_file(
-            Filename=final_video_path,
-            Bucket=R2_BUCKET_NAME,
-            Key=object_key,
-            ExtraArgs={"ContentType": "video/mp4"}
-        )
-        public_url = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key}"
-        cleanup_old_videos(s3_client, object_key)
-        
-        gc = get_gspread_client()
-        print(f"🔍 DEBUG gspread client: {'OK' if gc else 'FAILED'}", flush=True)
-        if gc and row_number > 0:
-            try:
-                sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
-                sheet.update_cell(row_number, 13, public_url)
-                sheet.update_cell(row_number, 2, "PRODOTTO")
-                print(f"📊 ✅ Sheet row {row_number}: M={public_url[:60]} + B=PRODOTTO (anti-loop)", flush=True)
-            except Exception as e:
-                print(f"❌ Sheets fallito row {row_number}: {str(e)}", flush=True)
-        
-        paths_to_cleanup = [audiopath, video_looped_path, final_video_path] + normalized_clips + [p[0] for p in scene_paths]
-        for path in paths_to_cleanup:
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-        
-        print(f"✅ 🎬 VIDEO AI TOOL MASTER COMPLETO: {real_duration/60:.1f}min → {public_url}", flush=True)
-        
-        job.update({
+        job = jobs.update(job_id, {
             "status": "completed",
             "video_url": public_url,
             "duration": real_duration,
-            "clips_used": len(scene_paths),
+            "clips_used": clips_used,
             "row_number": row_number
         })
 
         # Notifica n8n flusso 2
-        notify_n8n_flusso2(job)
+        if job and profile != "draft":
+            timer.begin("webhook")
+            notify_n8n_flusso2(job)
+            timer.end()
+        METRICS.inc("video_jobs_total", {"status": "completed"})
+        EVENTS.publish(job_id, "status", status="completed", video_url=public_url, duration=real_duration)
         
     except Exception as e:
-        print(f"❌ ERRORE PROCESSING: {e}", flush=True)
-        job.update({"status": "failed", "error": str(e)})
+        logger.error(f"❌ ERRORE PROCESSING: {e}")
+        timer.end()
+        # via i file di lavoro a metà; restano solo gli output degli stage completati
+        # (riprendibili con /resume/<job_id>), o niente con WORKSPACE_KEEP_FAILED=0
+        if WORKSPACE_KEEP_FAILED:
+            checkpoint.teardown()
+        else:
+            checkpoint.discard()
+        jobs.update(job_id, {"status": "failed", "error": str(e)})
+        METRICS.inc("video_jobs_total", {"status": "failed"})
+        EVENTS.publish(job_id, "status", status="failed", error=str(e))
     
     finally:
-        Thread(target=lambda: cleanup_job_delayed(job_id), daemon=True).start()
+        _job_context.timer = None
+        _job_context.workspace = None
+
+def job_priority(data):
+    try:
+        return int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return 0
+
+def resume_job(job, reason):
+    """Rimette in coda un job dal suo checkpoint; solleva QueueFullError se la coda è piena."""
+    job_id = job["job_id"]
+    data = job.get("data") or {}
+    previous = {"status": job.get("status"), "error": job.get("error")}
+    jobs.update(job_id, {"status": "queued", "error": None, "worker": current_worker()})
+    try:
+        position = scheduler.submit(job_id, data, job_priority(data))
+    except QueueFullError:
+        jobs.update(job_id, previous)
+        raise
+    jobs.update(job_id, {"resumed": job.get("resumed", 0) + 1})
+    logger.info(f"♻️ Job {job_id} rimesso in coda ({reason}), pos {position}")
+    return position
+
+_resume_lock = Lock()
+_resume_pid = None
+
+def resume_orphaned_jobs():
+    """Al primo request di ogni processo: riprende i job rimasti a metà da processi morti."""
+    global _resume_pid
+    with _resume_lock:
+        if _resume_pid == os.getpid():
+            return
+        _resume_pid = os.getpid()
+    me = current_worker()
+    for job in jobs.active():
+        owner = job.get("worker")
+        if "job_id" not in job or worker_alive(owner) or not jobs.claim(job["job_id"], owner, me):
+            continue
+        try:
+            resume_job(job, f"orfano di {owner}")
+        except QueueFullError as e:
+            jobs.update(job["job_id"], {"status": "failed", "error": f"resume: {e}"})
+        except Exception as e:
+            logger.warning(f"⚠️ Resume job {job['job_id']} fallito: {e}")
+
+def fail_job(job_id, error):
+    """Job scartato prima di partire (es. budget disco impossibile): riprendibile con /resume."""
+    jobs.update(job_id, {"status": "failed", "error": error})
+    METRICS.inc("video_jobs_total", {"status": "failed"})
+    EVENTS.publish(job_id, "status", status="failed", error=error)
+
+scheduler = JobScheduler(process_video_async, WORKER_CONCURRENT, WORKER_QUEUE, WORKSPACE_BUDGET, on_reject=fail_job)
+
+# -------------------------------------------------
+# Batch: pianificazione comune e pool di clip condiviso fra i job
+# -------------------------------------------------
+class SharedClipPool:
+    """Candidati per query condivisi dal batch, distribuiti a rotazione fra i job.
+
+    Ogni assegnazione prende il candidato successivo per quella query, saltando
+    quelli già usati dal job: job diversi ricevono clip diverse finché il pool basta.
+    """
+
+    def __init__(self, candidates):
+        self._candidates = candidates
+        self._next = defaultdict(int)
+
+    def assign(self, query, used):
+        candidates = self._candidates.get(query) or []
+        if not candidates:
+            return None
+        start = self._next[query]
+        for i in range(len(candidates)):
+            index = (start + i) % len(candidates)
+            if candidates[index][0] not in used:
+                self._next[query] = index + 1
+                return candidates[index]
+        self._next[query] = start + 1
+        return candidates[start % len(candidates)]
+
+
+def _link_into(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+def reserve_batch(pending):
+    """Prenota il budget disco per i primi job di `pending` che ci stanno (almeno uno, aspettando).
+
+    La prenotazione passa poi al worker dello scheduler che esegue il job.
+    """
+    admitted = 0
+    while admitted < len(pending):
+        if WORKSPACE_BUDGET.reserve(pending[admitted][0]):
+            admitted += 1
+        elif admitted:
+            break
+        else:
+            time.sleep(10)
+    return pending[:admitted]
+
+# Un batch alla volta in preparazione per processo (audio, ricerche, download);
+# _batch_backlog conta le righe accettate ma non ancora arrivate allo scheduler.
+_batch_slots = BoundedSemaphore(1)
+_batch_lock = Lock()
+_batch_backlog = 0
+
+def admit_batch_rows(count):
+    """Prenota `count` posti in coda per un batch; False se coda + batch in preparazione non bastano."""
+    global _batch_backlog
+    with _batch_lock:
+        if count > scheduler.capacity() - _batch_backlog:
+            return False
+        _batch_backlog += count
+        return True
+
+def release_batch_rows(count):
+    global _batch_backlog
+    with _batch_lock:
+        _batch_backlog -= count
+
+def run_batch(batch_id, members, admitted_rows):
+    """Thread del batch: prepara a blocchi i job che stanno nel budget disco.
+
+    Se la preparazione esplode i job restano riprendibili con /resume.
+    """
+    pending = list(members)
+    try:
+        with _batch_slots:
+            while pending:
+                admitted = reserve_batch(pending)
+                pending = pending[len(admitted):]
+                prepare_batch(batch_id, admitted)
+    except Exception as e:
+        logger.error(f"❌ Batch {batch_id} fallito: {e}")
+        for job_id, _data in members:
+            job = jobs.get(job_id)
+            if job and job.get("status") == "queued" and scheduler.position(job_id) is None:
+                WORKSPACE_BUDGET.release(job_id)
+                jobs.update(job_id, {"status": "failed", "error": f"batch: {e}"})
+    finally:
+        release_batch_rows(admitted_rows)
+
+def prepare_batch(batch_id, members):
+    """Audio e piano dei job (già ammessi nel budget disco), ricerca e download una sola volta.
+
+    Ogni job riceve in checkpoint gli stage audio/plan/acquire già fatti e viene
+    poi accodato: process_video_async riparte dalla normalizzazione.
+    """
+    started = time.perf_counter()
+    deadline = time.monotonic() + FETCH_DEADLINE
+    planned = []
+    for job_id, data in members:
+        checkpoint = JobCheckpoint(job_id)
+        try:
+            profile = job_profile(data)
+            script, sheet_keywords, _row = parse_job_fields(data)
+            audio = prepare_audio(checkpoint, data)
+            plan = plan_scenes(checkpoint, script, sheet_keywords, audio["duration"], profile)
+            planned.append((job_id, data, checkpoint, dict(plan, profile=profile)))
+        except Exception as e:
+            logger.error(f"❌ Batch {batch_id}: job {job_id} fallito in preparazione: {e}")
+            WORKSPACE_BUDGET.release(job_id)
+            jobs.update(job_id, {"status": "failed", "error": str(e)})
+    
+    # una ricerca per query distinta (e profilo, che decide la rendition) in tutto il batch
+    queries = sorted({(plan["profile"], scene["query"]) for *_rest, plan in planned for scene in plan["scenes"]})
+    with ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS), thread_name_prefix="batch-search") as executor:
+        found = dict(zip(queries, executor.map(lambda pq: search_candidates(pq[1], deadline, pq[0]), queries)))
+    pool = SharedClipPool(found)
+    
+    # scene interlacciate fra i job, così la rotazione sparge le clip su tutti
+    used = defaultdict(set)
+    picks = defaultdict(list)
+    for index in range(max((len(plan["scenes"]) for *_rest, plan in planned), default=0)):
+        for job_id, _data, _checkpoint, plan in planned:
+            if index >= len(plan["scenes"]):
+                continue
+            scene = plan["scenes"][index]
+            candidate = pool.assign((plan["profile"], scene["query"]), used[job_id])
+            if candidate:
+                used[job_id].add(candidate[0])
+                picks[job_id].append((scene["scene"], candidate, scene_clip_duration(plan["avg_scene_duration"])))
+    
+    # clip normalizzate in cache dove possibile, altrimenti un download per sorgente
+    cached = {}
+    needed = {}
+    profiles = {job_id: plan["profile"] for job_id, _data, _checkpoint, plan in planned}
+    for job_id, job_picks in picks.items():
+        for scene_number, (source_id, url, _final_source), duration in job_picks:
+            key = CLIP_CACHE.key(source_id, normalize_args(duration, profiles[job_id]))
+            path = CLIP_CACHE.fetch(key)
+            if path:
+                cached[(job_id, scene_number)] = path
+                continue
+            url_needed, longest = needed.get(source_id, (url, 0.0))
+            needed[source_id] = (url_needed, max(longest, duration))
+    
+    def download(item):
+        source_id, (url, duration) = item
+        try:
+            return source_id, download_file(url, duration)
+        except Exception as e:
+            logger.warning(f"⚠️ Batch {batch_id}: download {source_id} fallito: {e}")
+            return source_id, None
+    with ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS), thread_name_prefix="batch-fetch") as executor:
+        downloads = dict(executor.map(download, needed.items()))
+    
+    for job_id, data, checkpoint, plan in planned:
+        clips = []
+        for scene_number, (source_id, url, final_source), duration in picks.get(job_id, []):
+            name = f"scene_{scene_number:03d}.src.mp4"
+            key = CLIP_CACHE.key(source_id, normalize_args(duration, plan["profile"]))
+            if (job_id, scene_number) in cached:
+                path, normalized = checkpoint.adopt(cached[(job_id, scene_number)], name), True
+            elif downloads.get(source_id):
+                path, normalized = _link_into(downloads[source_id], checkpoint.path(name)), False
+            else:
+                continue
+            clips.append({"scene": scene_number, "path": path, "duration": duration,
+                          "normalized": normalized, "cache_key": key,
+                          "final_source": final_source, "profile": plan["profile"]})
+        # scene senza candidato o con download fallito: registrate senza file, il job
+        # le riacquisisce con fetch_clip_for_scene (candidato successivo, poi Pixabay)
+        acquired = {clip["scene"] for clip in clips}
+        clips += [{"scene": scene["scene"], "path": None} for scene in plan["scenes"] if scene["scene"] not in acquired]
+        clips.sort(key=lambda c: c["scene"])
+        checkpoint.save("acquire", clips=clips)
+    for path in downloads.values():
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    
+    scenes = sum(len(plan["scenes"]) for *_rest, plan in planned)
+    logger.info(
+        f"🧺 Batch {batch_id}: {len(planned)} job, {scenes} scene → {len(queries)} ricerche, "
+        f"{len(needed)} download, {len(cached)} clip da cache ({time.perf_counter() - started:.1f}s)"
+    )
+    
+    for job_id, data, _checkpoint, _plan in planned:
+        while True:
+            try:
+                scheduler.submit(job_id, data, job_priority(data))
+                break
+            except QueueFullError as e:
+                # backlog notturno: il batch aspetta che la coda si liberi
+                time.sleep(max(1.0, min(60.0, e.eta_seconds)))
+
+def ingest_batch_row(job_id, row):
+    """Riga del batch (JSON): audio base64 su disco, `audio_url` lasciato al job."""
+    data = dict(row)
+    job_profile(data)
+    audio_b64 = None
+    for field in AUDIO_PAYLOAD_FIELDS:
+        audio_b64 = data.pop(field, None) or audio_b64
+    if audio_b64:
+        path = audio_spool_path(job_id)
+        try:
+            spool_base64(audio_b64, path)
+        except Exception:
+            discard_spooled_audio({"audio_path": path})
+            raise
+        data["audio_path"] = path
+    elif not data.get("audio_url"):
+        raise ValueError("audio mancante (audio_base64 o audio_url)")
+    return data
 
-def cleanup_job_delayed(job_id, delay=3600):
-    import time
-    time.sleep(delay)
-    if job_id in jobs:
-        del jobs[job_id]
+@app.route("/generate-batch", methods=["POST"])
+def generate_batch():
+    """Molte righe in una richiesta: pianificazione e acquisizione clip condivise."""
+    try:
+        if request.content_length and request.content_length > MAX_BATCH_BYTES:
+            return jsonify({"success": False, "error": f"body oltre MAX_BATCH_BYTES ({MAX_BATCH_BYTES} byte): usare audio_url"}), 413
+        body = request.get_json(force=True) or {}
+        rows = body.get("rows", []) if isinstance(body, dict) else body
+        if not isinstance(rows, list) or not rows:
+            return jsonify({"success": False, "error": "rows mancante o vuoto"}), 400
+        if len(rows) > MAX_BATCH_ROWS:
+            return jsonify({"success": False, "error": f"massimo {MAX_BATCH_ROWS} righe per batch (MAX_BATCH_ROWS)"}), 413
+        if not admit_batch_rows(len(rows)):
+            position = scheduler.stats()["queued"] + 1
+            eta = scheduler.eta(position)
+            logger.warning(f"🚦 Coda piena, batch di {len(rows)} righe rifiutato")
+            resp = jsonify({"success": False, "error": f"Coda piena: posti liberi per meno di {len(rows)} job",
+                            "queue_position": position, "eta_seconds": eta})
+            resp.headers["Retry-After"] = str(max(1, int(eta)))
+            return resp, 429
+        
+        batch_id = uuid.uuid4().hex[:12]
+        members = []
+        results = []
+        for index, row in enumerate(rows):
+            job_id = str(uuid.uuid4())
+            # la riga (con il suo base64) non serve più dopo l'ingestione
+            rows[index] = None
+            try:
+                data = ingest_batch_row(job_id, row)
+            except Exception as e:
+                results.append({"index": index, "row_number": (row or {}).get("row_number") if isinstance(row, dict) else None,
+                                "success": False, "error": str(e)})
+                continue
+            jobs.create(job_id, {
+                "job_id": job_id,
+                "status": "queued",
+                "created_at": dt.datetime.utcnow().isoformat(),
+                "data": data,
+                "worker": current_worker(),
+                "batch_id": batch_id,
+            })
+            members.append((job_id, data))
+            results.append({"index": index, "row_number": data.get("row_number"), "success": True, "job_id": job_id})
+        
+        release_batch_rows(len(rows) - len(members))
+        if members:
+            Thread(target=run_batch, args=(batch_id, members, len(members)), name=f"batch-{batch_id}", daemon=True).start()
+        logger.info(f"🧺 Batch {batch_id}: {len(members)}/{len(rows)} righe accettate")
+        return jsonify({
+            "success": bool(members),
+            "batch_id": batch_id,
+            "jobs": results,
+            "message": "Batch in preparazione (check /status/<job_id> per ogni riga)",
+        })
+    
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route("/generate", methods=["POST"])
 def generate():
     try:
-        data = request.get_json(force=True) or {}
         job_id = str(uuid.uuid4())
+        data = ingest_request(job_id)
+        priority = job_priority(data)
+        try:
+            job_profile(data)
+        except ValueError as e:
+            discard_spooled_audio(data)
+            return jsonify({"success": False, "error": str(e)}), 400
         
-        jobs[job_id] = {
+        jobs.create(job_id, {
+            "job_id": job_id,
             "status": "queued",
             "created_at": dt.datetime.utcnow().isoformat(),
-            "data": data
-        }
-        
-        if len(jobs) > MAX_JOBS:
-            old_jobs = sorted(jobs.keys(), key=lambda k: jobs[k]["created_at"])[:len(jobs)-MAX_JOBS]
-            for oj in old_jobs:
-                del jobs[oj]
+            "data": data,
+            "worker": current_worker(),
+        })
         
-        Thread(target=process_video_async, args=(job_id, data), daemon=True).start()
+        try:
+            position = scheduler.submit(job_id, data, priority)
+        except QueueFullError as e:
+            jobs.delete(job_id)
+            discard_spooled_audio(data)
+            logger.warning(f"🚦 Coda piena, job rifiutato: raw_row={data.get('row_number')}")
+            resp = jsonify({
+                "success": False,
+                "error": str(e),
+                "queue_position": e.position,
+                "eta_seconds": e.eta_seconds,
+            })
+            resp.headers["Retry-After"] = str(max(1, int(e.eta_seconds)))
+            return resp, 429
         
-        print(f"🚀 Job {job_id} QUEUED: raw_row={data.get('row_number')}", flush=True)
+        logger.info(f"🚀 Job {job_id} QUEUED (pos {position}): raw_row={data.get('row_number')}")
         return jsonify({
             "success": True,
             "job_id": job_id,
             "status": "queued",
+            "queue_position": position,
+            "eta_seconds": scheduler.eta(position),
             "message": "Video generation started (check /status/<job_id>)"
         })
     
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/resume/<job_id>", methods=["POST"])
+def resume(job_id):
+    """Riprende un job fallito (o orfano) dagli stage già in checkpoint."""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] == "completed":
+        return jsonify({"error": "Job già completato", "video_url": job.get("video_url")}), 409
+    owner = job.get("worker")
+    if job["status"] in ACTIVE_STATUSES and worker_alive(owner):
+        return jsonify({"error": f"Job {job['status']} in un processo attivo", "worker": owner}), 409
+    if not jobs.claim(job_id, owner, current_worker()):
+        return jsonify({"error": "Job ripreso da un altro processo"}), 409
+    try:
+        position = resume_job(dict(job, job_id=job_id), "richiesta /resume")
+    except QueueFullError as e:
+        resp = jsonify({"success": False, "error": str(e), "queue_position": e.position, "eta_seconds": e.eta_seconds})
+        resp.headers["Retry-After"] = str(max(1, int(e.eta_seconds)))
+        return resp, 429
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "queue_position": position,
+        "checkpoint": job.get("checkpoint", []),
+    })
+
+@app.route("/promote/<job_id>", methods=["POST"])
+def promote(job_id):
+    """Promuove una draft approvata a final: stesso audio, stesso piano, stesse clip."""
+    draft = jobs.get(job_id)
+    if not draft:
+        return jsonify({"error": "Job not found"}), 404
+    if draft["status"] != "completed" or (draft.get("data") or {}).get("profile") != "draft":
+        return jsonify({"error": "Solo una draft completata può essere promossa"}), 409
+    if draft.get("promoted_to"):
+        return jsonify({"error": "Draft già promossa", "job_id": draft["promoted_to"]}), 409
+    source = JobCheckpoint(job_id)
+    audio = source.done("audio", "path")
+    plan = source.done("plan")
+    if audio is None or plan is None:
+        return jsonify({"error": "Checkpoint della draft scaduto, rigenerare il video"}), 410
+    selection = {c["scene"]: c.get("final_source") for c in (source.stages.get("acquire") or {}).get("clips", [])}
+    
+    final_id = str(uuid.uuid4())
+    # una sola promozione per draft anche con /promote concorrenti (anche su worker diversi)
+    if not jobs.set_once(job_id, "promoted_to", final_id):
+        return jsonify({"error": "Draft già promossa", "job_id": (jobs.get(job_id) or {}).get("promoted_to")}), 409
+    data = {k: v for k, v in draft["data"].items() if k not in ("audio_path", "audio_url")}
+    data.update({"profile": "final", "promoted_from": job_id})
+    checkpoint = JobCheckpoint(final_id)
+    jobs.create(final_id, {
+        "job_id": final_id,
+        "status": "queued",
+        "created_at": dt.datetime.utcnow().isoformat(),
+        "data": data,
+        "worker": current_worker(),
+        "promoted_from": job_id,
+    })
+    checkpoint.save("audio", path=_link_into(audio["path"], checkpoint.path("audio.wav")), duration=audio["duration"])
+    checkpoint.save("plan", avg_scene_duration=plan["avg_scene_duration"], scenes=[
+        dict(scene, source=selection.get(scene["scene"])) for scene in plan["scenes"]
+    ])
+    try:
+        position = scheduler.submit(final_id, data, job_priority(data))
+    except QueueFullError as e:
+        jobs.delete(final_id)
+        checkpoint.discard()
+        jobs.update(job_id, {"promoted_to": None})
+        resp = jsonify({"success": False, "error": str(e), "queue_position": e.position, "eta_seconds": e.eta_seconds})
+        resp.headers["Retry-After"] = str(max(1, int(e.eta_seconds)))
+        return resp, 429
+    logger.info(f"⬆️ Draft {job_id} promossa a final: job {final_id} (pos {position})")
+    return jsonify({
+        "success": True,
+        "job_id": final_id,
+        "promoted_from": job_id,
+        "status": "queued",
+        "queue_position": position,
+        "eta_seconds": scheduler.eta(position),
+    })
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,445 @@
+"""Benchmark offline end-to-end di process_video_async.
+
+Gira la pipeline completa senza API reali:
+- server HTTP locale che imita Pexels /videos/search e Pixabay /api/videos/
+  e serve clip sintetiche generate con ffmpeg lavfi (con supporto Range)
+- stub S3 locale al posto di get_s3_client (R2)
+- client gspread finto al posto di get_gspread_client
+
+Ogni scenario (durata audio × MAX_CLIPS) gira in un sottoprocesso separato, così
+peak RSS e disco sono isolati. Uso:
+
+    python bench.py --durations 60,300,720 --clips 10,40 > bench_output.txt
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CLIP_VARIANTS = [("testsrc2", "developer coding on laptop"), ("testsrc", "data dashboard analytics"),
+                 ("smptebars", "technology office screen"), ("rgbtestsrc", "software workflow business")]
+RENDITIONS = [(1920, 1080), (1280, 720)]
+
+
+# -------------------------------------------------
+# Fake Pexels / Pixabay
+# -------------------------------------------------
+def make_clips(clip_dir, seconds=8):
+    """Genera le clip sintetiche (una per variante e rendition) con ffmpeg lavfi."""
+    os.makedirs(clip_dir, exist_ok=True)
+    for i, (source, _desc) in enumerate(CLIP_VARIANTS):
+        for width, height in RENDITIONS:
+            path = os.path.join(clip_dir, f"{i}_{height}.mp4")
+            if os.path.exists(path):
+                continue
+            subprocess.run([
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "lavfi", "-i", f"{source}=size={width}x{height}:rate=30", "-t", str(seconds),
+                "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", path
+            ], check=True)
+
+
+class FakeStockHandler(BaseHTTPRequestHandler):
+    clip_dir = None
+    latency = 0.0
+
+    def log_message(self, *_args):
+        pass
+
+    def _json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _base(self):
+        return f"http://{self.headers['Host']}"
+
+    def _pexels(self, query):
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["25"])[0])
+        videos = []
+        for n in range(per_page):
+            variant = n % len(CLIP_VARIANTS)
+            videos.append({
+                "id": page * 1000 + n,
+                "description": CLIP_VARIANTS[variant][1],
+                "tags": ["technology", "computer"],
+                "video_files": [
+                    {"id": page * 1000 + n * 10 + h, "width": w, "height": h,
+                     "link": f"{self._base()}/clips/{variant}_{h}.mp4"}
+                    for w, h in RENDITIONS
+                ],
+            })
+        self._json({"page": page, "per_page": per_page, "videos": videos})
+
+    def _pixabay(self, query):
+        per_page = int(query.get("per_page", ["25"])[0])
+        hits = []
+        for n in range(per_page):
+            variant = n % len(CLIP_VARIANTS)
+            hits.append({
+                "id": 50000 + n,
+                "tags": CLIP_VARIANTS[variant][1].replace(" ", ", "),
+                "videos": {
+                    "large": {"url": f"{self._base()}/clips/{variant}_1080.mp4", "width": 1920, "height": 1080},
+                    "medium": {"url": f"{self._base()}/clips/{variant}_720.mp4", "width": 1280, "height": 720},
+                },
+            })
+        self._json({"total": per_page, "hits": hits})
+
+    def _clip(self, name):
+        path = os.path.join(self.clip_dir, os.path.basename(name))
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+            else:
+                start = size - int(match.group(2))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 256 * 1024))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/videos/search":
+            time.sleep(self.latency)
+            self._pexels(query)
+        elif url.path == "/api/videos/":
+            time.sleep(self.latency)
+            self._pixabay(query)
+        elif url.path.startswith("/clips/"):
+            self._clip(url.path[len("/clips/"):])
+        else:
+            self.send_error(404)
+
+
+def start_fake_stock(clip_dir, latency):
+    FakeStockHandler.clip_dir = clip_dir
+    FakeStockHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeStockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# -------------------------------------------------
+# Fake R2 (S3) e Google Sheets
+# -------------------------------------------------
+class _FakePaginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix=""):
+        keys = sorted(k for k in self.client.objects if k.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), 1000):
+            page = keys[i:i + 1000]
+            yield {"Contents": [{"Key": k, "Size": self.client.objects[k]} for k in page]} if page else {}
+
+
+class FakeS3Client:
+    """Stub S3 su filesystem locale con le API usate dalla pipeline."""
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = {}
+        self.uploads = {}
+        self.calls = 0
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        self.calls += 1
+        os.makedirs(os.path.dirname(self._path(Key)), exist_ok=True)
+        shutil.copyfile(Filename, self._path(Key))
+        self.objects[Key] = os.path.getsize(Filename)
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.calls += 1
+        os.makedirs(os.path.dirname(self._path(Key)), exist_ok=True)
+        with open(self._path(Key), "wb") as f:
+            f.write(Body)
+        self.objects[Key] = len(Body)
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None):
+        self.calls += 1
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls += 1
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls += 1
+        parts = self.uploads.pop(UploadId)
+        body = b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+        self.calls -= 1
+        self.put_object(Bucket, Key, body)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls += 1
+        self.uploads.pop(UploadId, None)
+
+    def get_paginator(self, _name):
+        self.calls += 1
+        return _FakePaginator(self)
+
+    def delete_objects(self, Bucket, Delete):
+        self.calls += 1
+        for obj in Delete["Objects"]:
+            self.objects.pop(obj["Key"], None)
+            try:
+                os.unlink(self._path(obj["Key"]))
+            except FileNotFoundError:
+                pass
+        return {"Errors": []}
+
+    def delete_object(self, Bucket, Key):
+        self.calls += 1
+        self.objects.pop(Key, None)
+        try:
+            os.unlink(self._path(Key))
+        except FileNotFoundError:
+            pass
+
+
+class _FakeWorksheet:
+    def __init__(self, client):
+        self.client = client
+
+    def update_cell(self, row, col, value):
+        self.client.calls += 1
+        self.client.cells[(row, col)] = value
+
+    def batch_update(self, data, raw=True, **_kwargs):
+        self.client.calls += 1
+        for item in data:
+            self.client.cells[item["range"]] = item["values"][0][0]
+
+
+class _FakeSpreadsheet:
+    def __init__(self, client):
+        self.sheet1 = _FakeWorksheet(client)
+
+
+class FakeGspreadClient:
+    def __init__(self):
+        self.cells = {}
+        self.calls = 0
+
+    def open_by_key(self, _key):
+        self.calls += 1
+        return _FakeSpreadsheet(self)
+
+
+# -------------------------------------------------
+# Misure
+# -------------------------------------------------
+class DiskSampler:
+    """Campiona lo spazio occupato sotto `root` e ne tiene il picco."""
+
+    def __init__(self, root, interval=0.2):
+        self.root = root
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _usage(self):
+        total = 0
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._usage())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._usage())
+
+
+def run_scenario(duration, clips, latency, warm):
+    """Un job end-to-end in questo processo; ritorna il dict dei risultati."""
+    work = tempfile.mkdtemp(prefix="bench_")
+    scratch = os.path.join(work, "tmp")
+    os.makedirs(scratch)
+    clip_dir = os.path.join(tempfile.gettempdir(), "bench_clips")
+    make_clips(clip_dir)
+    server = start_fake_stock(clip_dir, latency)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    os.environ.update({
+        "TMPDIR": scratch,
+        "JOB_STORE": "memory",
+        "MAX_CLIPS": str(clips),
+        "PEXELS_API_KEY": "bench", "PIXABAY_API_KEY": "bench",
+        "PEXELS_SEARCH_URL": f"{base}/videos/search",
+        "PIXABAY_SEARCH_URL": f"{base}/api/videos/",
+        "PEXELS_RPS": "0", "PIXABAY_RPS": "0",
+        "R2_ACCESS_KEY_ID": "bench", "R2_SECRET_ACCESS_KEY": "bench",
+        "R2_BUCKET_NAME": "bench", "R2_PUBLIC_BASE_URL": "http://r2.local", "R2_ACCOUNT_ID": "bench",
+    })
+    if not warm:
+        os.environ.update({"SEARCH_CACHE_TTL": "0", "CLIP_CACHE_MAX_BYTES": "0"})
+    os.environ.pop("N8N_WEBHOOK_URL_AI_TOOL_MASTER_FLUSSO2", None)
+    tempfile.tempdir = None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    s3 = FakeS3Client(os.path.join(work, "r2"))
+    gc = FakeGspreadClient()
+    app.get_s3_client = lambda: s3
+    app.get_gspread_client = lambda: gc
+
+    audio_path = app.audio_spool_path("bench")
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:a", "libmp3lame", "-b:a", "128k", "-f", "mp3", audio_path
+    ], check=True)
+    script = " ".join(["intelligenza artificiale tool workflow coding dashboard api"] * int(duration))
+    app.jobs.create("bench", {"status": "queued"})
+
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    with DiskSampler(scratch) as disk:
+        app.process_video_async("bench", {
+            "audio_path": audio_path, "script": script, "keywords": "ai tool", "row_number": 2,
+            "title": "bench",
+        })
+    app.SHEETS.drain()
+    wall = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    job = app.jobs.get("bench")
+    server.shutdown()
+    shutil.rmtree(work, ignore_errors=True)
+    return {
+        "duration": duration,
+        "clips": clips,
+        "status": job["status"],
+        "error": job.get("error"),
+        "wall_seconds": round(wall, 2),
+        "cpu_self_seconds": round((self_after.ru_utime + self_after.ru_stime)
+                                  - (self_before.ru_utime + self_before.ru_stime), 2),
+        "cpu_children_seconds": round((children_after.ru_utime + children_after.ru_stime)
+                                      - (children_before.ru_utime + children_before.ru_stime), 2),
+        "peak_rss_mb": round(self_after.ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(children_after.ru_maxrss / 1024, 1),
+        "peak_disk_mb": round(disk.peak / 1024 ** 2, 1),
+        "s3_calls": s3.calls,
+        "sheets_calls": gc.calls,
+        "stages": job.get("timings", {}),
+    }
+
+
+def print_report(results):
+    stages = []
+    for r in results:
+        for name in r["stages"]:
+            if name not in stages:
+                stages.append(name)
+    header = f"{'audio':>6} {'clips':>5} {'status':>9} {'wall':>8} {'cpu':>8} {'rss MB':>7} {'disk MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cpu = r["cpu_self_seconds"] + r["cpu_children_seconds"]
+        rss = max(r["peak_rss_mb"], r["peak_child_rss_mb"])
+        print(f"{r['duration']:>5}s {r['clips']:>5} {r['status']:>9} {r['wall_seconds']:>7.1f}s {cpu:>7.1f}s "
+              f"{rss:>7.1f} {r['peak_disk_mb']:>8.1f}")
+        for name in stages:
+            st = r["stages"].get(name)
+            if st:
+                extra = " ".join(f"{k}={v}" for k, v in st.items() if k not in ("wall_seconds", "cpu_seconds"))
+                print(f"{'':>14}{name:<10} wall {st['wall_seconds']:>7.2f}s  cpu {st['cpu_seconds']:>7.2f}s  {extra}")
+        if r["error"]:
+            print(f"{'':>14}error: {r['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--durations", default="60,300,720", help="durate audio in secondi, separate da virgola")
+    parser.add_argument("--clips", default="10,40", help="valori di MAX_CLIPS, separati da virgola")
+    parser.add_argument("--latency", type=float, default=0.05, help="latenza finta delle API di ricerca (s)")
+    parser.add_argument("--warm", action="store_true", help="lascia attive search cache e clip cache")
+    parser.add_argument("--json", help="scrive anche i risultati grezzi in questo file")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        duration, clips = (int(v) for v in args.scenario.split(":"))
+        result = run_scenario(duration, clips, args.latency, args.warm)
+        print("BENCH_RESULT " + json.dumps(result))
+        return
+
+    results = []
+    for duration in (int(v) for v in args.durations.split(",")):
+        for clips in (int(v) for v in args.clips.split(",")):
+            cmd = [sys.executable, os.path.abspath(__file__), "--scenario", f"{duration}:{clips}",
+                   "--latency", str(args.latency)] + (["--warm"] if args.warm else [])
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            lines = [l for l in proc.stdout.splitlines() if l.startswith("BENCH_RESULT ")]
+            if not lines:
+                print(f"⚠️ Scenario {duration}s/{clips} clip senza risultato (exit {proc.returncode})", file=sys.stderr)
+                print(proc.stderr[-2000:], file=sys.stderr)
+                continue
+            results.append(json.loads(lines[-1][len("BENCH_RESULT "):]))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()